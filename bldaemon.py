@@ -0,0 +1,220 @@
+"""
+Copyright 2020 Renze Nicolai
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os, json, time, queue, argparse, threading, socketserver
+import bltool
+
+class JobReporter(bltool.Reporter):
+    # Sends the progress of a job to the client that submitted it as JSON lines
+    def __init__(self, job):
+        super(JobReporter, self).__init__()
+        self.job = job
+
+    def message(self, text):
+        self.stage = text
+        self.steps = 0
+        self.job.send({"event": "message", "text": text})
+
+    def step(self, symbol = "."):
+        self.steps += 1
+        if symbol != ".":
+            self.job.send({"event": "retry", "stage": self.stage, "steps": self.steps})
+        elif self.steps % 32 == 0:
+            self.job.send({"event": "progress", "stage": self.stage, "steps": self.steps})
+
+    def end(self):
+        pass
+
+class Job:
+    def __init__(self, number, request):
+        self.number = number
+        self.request = request
+        self.events = queue.Queue()
+
+    def send(self, event):
+        event["job"] = self.number
+        self.events.put(event)
+
+    def finish(self, event):
+        self.send(event)
+        self.events.put(None)
+
+class PortWorker:
+    # Owns one serial port, keeps the eflash loader session on it running and handles its jobs one by one
+    def __init__(self, portName, options):
+        self.portName = portName
+        self.options = options
+        self.port = None
+        self.eflash = None
+        self.current = None
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def status(self):
+        return {"port": self.portName, "session": self.eflash != None, "busy": self.current != None, "queued": self.jobs.qsize()}
+
+    def connect(self, reporter, statistics):
+        # Reuses the running session when the loader still answers, starts a new one otherwise
+        if self.eflash != None:
+            self.eflash.reporter = reporter
+            self.eflash.statistics = statistics
+            if self.eflash.isAlive():
+                return
+            self.eflash = None
+        if self.port == None:
+            self.port = bltool.openPort(self.portName, self.options.baudrate[0])
+        start = time.monotonic()
+        self.eflash = bltool.startSession(self.port, self.options, reporter, statistics)
+        statistics.addStage("loader", start)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            self.current = job
+            start = time.monotonic()
+            statistics = bltool.Statistics(self.portName)
+            try:
+                args = jobArguments(job.request, self.options)
+            except Exception as e:
+                job.finish({"event": "error", "error": str(e), "duration": time.monotonic() - start})
+                self.current = None
+                continue
+            try:
+                self.connect(JobReporter(job), statistics)
+                passed = bltool.runActions(self.eflash, self.portName, args)
+                job.finish({"event": "done", "passed": passed, "duration": time.monotonic() - start, "statistics": statistics.summary()})
+            except Exception as e:
+                # The next job starts from scratch, the port may have been unplugged or the board reset
+                self.eflash = None
+                if self.port != None:
+                    self.port.close()
+                    self.port = None
+                job.finish({"event": "error", "error": str(e), "duration": time.monotonic() - start})
+            self.current = None
+
+def jobArguments(request, options):
+    # Turns a job request into the arguments bltool.runActions expects, the session options come from the daemon
+    args = argparse.Namespace(**vars(options))
+    writes = [(region["address"], region["file"]) for region in request.get("write", [])]
+    if "manifest" in request:
+        writes += bltool.loadManifest(request["manifest"])
+    regions = [(address, bltool.mapFile(filename), filename) for (address, filename) in writes]
+    if "sparse" in request:
+        regions += bltool.loadSparse(request["sparse"])
+    args.regions = bltool.planRegions(regions)
+    args.ota = [request["ota"]] if "ota" in request else None
+    args.erase = request.get("erase", False)
+    args.noErase = request.get("noErase", False)
+    args.differential = request.get("differential", False)
+    args.verify = request.get("verify", False)
+    args.verifyOnly = request.get("verifyOnly", False)
+    args.writeBlank = request.get("writeBlank", False)
+    args.matchFlash = request.get("matchFlash", False)
+    args.journal = [request["journal"]] if "journal" in request else None
+    args.pipeline = [request.get("pipeline", options.pipeline[0])]
+    args.readPartitions = request.get("partitions", None)
+    args.partitionDirectory = [request.get("partitionDirectory", ".")]
+    args.trim = request.get("trim", False)
+    args.read = None
+    if "read" in request:
+        args.read = [request["read"]["address"], request["read"]["length"], request["read"]["file"]]
+    return args
+
+class Daemon:
+    def __init__(self, options):
+        self.options = options
+        self.workers = {}
+        self.lock = threading.Lock()
+        self.jobCount = 0
+
+    def worker(self, portName):
+        with self.lock:
+            if not portName in self.workers:
+                self.workers[portName] = PortWorker(portName, self.options)
+            return self.workers[portName]
+
+    def submit(self, request):
+        with self.lock:
+            self.jobCount += 1
+            job = Job(self.jobCount, request)
+        worker = self.worker(request["port"])
+        job.send({"event": "queued", "port": request["port"], "position": worker.jobs.qsize() + (1 if worker.current != None else 0)})
+        worker.jobs.put(job)
+        return job
+
+    def status(self):
+        with self.lock:
+            workers = list(self.workers.values())
+        return {"event": "status", "ports": [worker.status() for worker in workers]}
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    # Every line a client sends is a request, the answer is streamed back as JSON lines
+    def handle(self):
+        for line in self.rfile:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                request = json.loads(line)
+                action = request.get("action", "flash")
+                if action == "status":
+                    self.send(self.server.daemon.status())
+                    continue
+                if action != "flash" or not "port" in request:
+                    raise Exception("Invalid request", action)
+            except Exception as e:
+                self.send({"event": "error", "error": str(e)})
+                continue
+            job = self.server.daemon.submit(request)
+            while True:
+                event = job.events.get()
+                if event == None:
+                    break
+                self.send(event)
+
+    def send(self, event):
+        self.wfile.write((json.dumps(event) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def main():
+    parser = argparse.ArgumentParser(description="BL602 flashing daemon, accepts jobs as JSON lines on a Unix socket")
+    parser.add_argument("-s", "--socket", dest="socket", default="/tmp/bltool.sock", help="Path of the Unix socket to listen on (default: /tmp/bltool.sock)")
+    parser.add_argument("-p", "--port", dest="port", nargs="+", default=[], help="Serial ports to start a session on right away")
+    parser.add_argument("-b", "--baudrate", dest="baudrate", nargs=1, default=[115200], type=int, help="The speed at which to communicate with the bootrom")
+    parser.add_argument("-f", "--flash-baudrate", dest="flashBaudrate", nargs=1, default=["auto"], help="The speed at which to communicate with the eflash loader (default: auto)")
+    parser.add_argument("--loader", dest="loader", nargs=1, default=["auto"], choices=["auto"] + list(bltool.loaderFiles.keys()), help="The eflash loader to use (default: auto)")
+    parser.add_argument("-P", "--pipeline", dest="pipeline", nargs=1, default=[1], type=int, help="Default amount of program commands to keep in flight while writing (default: 1)")
+    parser.add_argument("-L", "--logging", dest="logging", action="store_true", help="Enable communication debug logging")
+    options = parser.parse_args()
+    options.info = False
+    options.reload = False
+
+    daemon = Daemon(options)
+    for portName in options.port:
+        # An empty job gets the loader running, so the first real job does not have to wait for it
+        daemon.submit({"port": portName})
+
+    if os.path.exists(options.socket):
+        os.remove(options.socket)
+    server = Server(options.socket, RequestHandler)
+    server.daemon = daemon
+    print("Listening on {}".format(options.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.remove(options.socket)
+
+if __name__ == "__main__":
+    main()
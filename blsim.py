@@ -0,0 +1,348 @@
+"""
+Copyright 2020 Renze Nicolai
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os, time, struct, hashlib, random, threading, argparse
+
+class SimulatedDevice:
+    # Model of a BL602 with the bootrom and eflash loader protocols on its UART and a NOR flash chip
+    def __init__(self, flashSize = 2*1024*1024, maxBaudrate = 2000000, processingDelay = 0.0005, errorRate = 0.0, dropRate = 0.0, corruptRate = 0.0, jedecId = 0xef4015):
+        self.flash = bytearray([0xFF] * flashSize)
+        self.jedecId = jedecId                    # Manufacturer, memory type and capacity of the flash chip
+        self.efuse = bytearray(128)
+        self.maxBaudrate = maxBaudrate            # Faster baudrates do not sync
+        self.processingDelay = processingDelay    # Time the device needs for every command (seconds)
+        self.errorRate = errorRate                # Chance that an erase or program command fails with FL
+        self.dropRate = dropRate                  # Chance that a command gets no response at all
+        self.corruptRate = corruptRate            # Chance that a byte of read data is corrupted on the wire
+        self.timing = {
+            "sector": 0.045,    # 4K sector erase
+            "block32": 0.12,    # 32K block erase
+            "block64": 0.15,    # 64K block erase
+            "chip": 5.0,        # Full chip erase
+            "page": 0.0007,     # 256 byte page program
+            "hash": 0.00000005, # SHA-256 per byte
+        }
+        self.bootromVersion = 1
+        self.otp = bytes(range(16))
+        self.reset()
+
+    def reset(self):
+        self.mode = "bootrom"
+        self.rx = bytearray()
+        self.syncedBaudrate = None
+        self.busyUntil = 0
+        self.segmentLength = 0
+        self.segmentData = bytearray()
+        self.commandCounts = {}
+
+    def receive(self, data, arrival, baudrate):
+        # Feeds bytes that arrived at the given time, returns (response, readyTime) for every completed frame
+        self.rx += data
+        responses = []
+        while len(self.rx) > 0:
+            if self.rx[0] == ord("U"):
+                while len(self.rx) > 0 and self.rx[0] == ord("U"):
+                    del self.rx[0]
+                if len(self.rx) == 0:
+                    # End of a sync pattern, the UART measures the baudrate from it
+                    if baudrate > self.maxBaudrate:
+                        self.syncedBaudrate = None
+                        responses.append((bytes([0x00, 0xF0]), self.schedule(arrival, 0)))
+                    else:
+                        self.syncedBaudrate = baudrate
+                        responses.append((b"OK", self.schedule(arrival, 0)))
+                continue
+            if len(self.rx) < 4:
+                break
+            length = self.rx[2] + (self.rx[3] << 8)
+            if len(self.rx) < 4 + length:
+                break
+            frame = bytes(self.rx[:4 + length])
+            del self.rx[:4 + length]
+            if self.syncedBaudrate != baudrate:
+                # The UART runs at another baudrate and only sees garbage
+                continue
+            (response, duration) = self.execute(frame[0], frame[1], frame[4:])
+            if response != None:
+                responses.append((response, self.schedule(arrival, duration)))
+        return responses
+
+    def schedule(self, arrival, duration):
+        # Commands are processed one after the other
+        start = max(arrival, self.busyUntil)
+        self.busyUntil = start + self.processingDelay + duration
+        return self.busyUntil
+
+    def execute(self, cmdId, checksum, params):
+        self.commandCounts[cmdId] = self.commandCounts.get(cmdId, 0) + 1
+        if random.random() < self.dropRate:
+            return (None, 0)
+        if self.mode == "bootrom":
+            return self.executeBootrom(cmdId, params)
+        calcChecksum = (len(params) + (len(params) >> 8) + sum(params)) & 0xFF
+        if checksum != calcChecksum:
+            return (self.error(0x0104), 0)
+        if cmdId in (0x30, 0x31, 0x3C) and random.random() < self.errorRate:
+            return (self.error(0x0301), 0)
+        return self.executeEflash(cmdId, params)
+
+    def executeBootrom(self, cmdId, params):
+        if cmdId == 0x10: # get_boot_info
+            return (self.payload(struct.pack("<L", self.bootromVersion) + self.otp), 0)
+        if cmdId in (0x11, 0x12, 0x13, 0x14, 0x15, 0x16): # boot header, keys, signatures and aes iv
+            return (b"OK", 0)
+        if cmdId == 0x17: # load_seg_header
+            (_, self.segmentLength, _, _) = struct.unpack("<LLLL", params)
+            self.segmentData = bytearray()
+            return (self.payload(params), 0)
+        if cmdId == 0x18: # load_seg_data
+            self.segmentData += params
+            return (b"OK", 0)
+        if cmdId == 0x19: # check_image
+            if len(self.segmentData) != self.segmentLength:
+                return (self.error(0x0205), 0)
+            return (b"OK", 0)
+        if cmdId == 0x1a: # run_image, the eflash loader syncs again at a baudrate of its own choice
+            self.mode = "eflash"
+            self.syncedBaudrate = None
+            return (b"OK", 0)
+        if cmdId == 0x20: # change_rate
+            (_, self.syncedBaudrate) = struct.unpack("<LL", params)
+            return (b"OK", 0)
+        if cmdId == 0x21: # reset
+            self.reset()
+            return (None, 0)
+        if cmdId in (0x30, 0x31, 0x32):
+            return self.executeEflash(cmdId, params)
+        if cmdId == 0x33: # flash_boot
+            return (b"OK", 0)
+        if cmdId == 0x40: # efuse_write
+            (addr,) = struct.unpack("<L", params[:4])
+            self.efuse[addr:addr + len(params) - 4] = params[4:]
+            return (b"OK", 0)
+        if cmdId == 0x41: # efuse_read
+            (addr, length) = struct.unpack("<LL", params) if len(params) == 8 else (0, len(self.efuse))
+            return (self.payload(self.efuse[addr:addr + length]), 0)
+        return (self.error(0x0102), 0)
+
+    def executeEflash(self, cmdId, params):
+        if cmdId == 0x3C: # chip_erase
+            self.flash[:] = bytes([0xFF] * len(self.flash))
+            return (b"OK", self.timing["chip"])
+        if cmdId == 0x30: # flash_erase, the end address is inclusive
+            (start, end) = struct.unpack("<LL", params)
+            if end < start or end >= len(self.flash):
+                return (self.error(0x0302), 0)
+            start &= ~0xFFF
+            end |= 0xFFF
+            self.flash[start:end + 1] = bytes([0xFF] * (end + 1 - start))
+            duration = 0
+            addr = start
+            while addr <= end:
+                if addr & 0xFFFF == 0 and end + 1 - addr >= 0x10000:
+                    (size, duration) = (0x10000, duration + self.timing["block64"])
+                elif addr & 0x7FFF == 0 and end + 1 - addr >= 0x8000:
+                    (size, duration) = (0x8000, duration + self.timing["block32"])
+                else:
+                    (size, duration) = (0x1000, duration + self.timing["sector"])
+                addr += size
+            return (b"OK", duration)
+        if cmdId == 0x31: # flash_program
+            (addr,) = struct.unpack("<L", params[:4])
+            data = params[4:]
+            if addr + len(data) > len(self.flash):
+                return (self.error(0x0303), 0)
+            # NOR flash can only clear bits, programming without erasing mixes old and new data
+            self.flash[addr:addr + len(data)] = bytes([a & b for (a, b) in zip(self.flash[addr:addr + len(data)], data)])
+            return (b"OK", self.timing["page"] * ((len(data) + 255) // 256))
+        if cmdId == 0x3A: # flash_check
+            return (b"OK", 0)
+        if cmdId == 0x32: # flash_read
+            (addr, length) = struct.unpack("<LL", params)
+            data = bytearray(self.flash[addr:addr + length])
+            if len(data) > 0 and random.random() < self.corruptRate:
+                data[random.randrange(len(data))] ^= 0x10
+            return (self.payload(data), 0)
+        if cmdId == 0x36: # flash_read_jid
+            return (self.payload(struct.pack(">L", self.jedecId << 8)), 0)
+        if cmdId == 0x3D: # sha256_read
+            (addr, length) = struct.unpack("<LL", params)
+            return (self.payload(hashlib.sha256(self.flash[addr:addr + length]).digest()), self.timing["hash"] * length)
+        # Bootrom commands end up here once the eflash loader runs
+        return (self.error(0x0103), 0)
+
+    def payload(self, data):
+        return b"OK" + struct.pack("<H", len(data)) + bytes(data)
+
+    def error(self, code):
+        return b"FL" + struct.pack("<H", code)
+
+class SimulatedPort:
+    # Stands in for a pyserial port, bytes take as long as they would on a real UART (8N1) plus a link latency
+    def __init__(self, device, baudrate = 115200, timeout = 0.1, latency = 0.0):
+        self.device = device
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.latency = latency
+        self.txFree = 0
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def wireTime(self, amount):
+        return amount * 10 / self.baudrate
+
+    def write(self, data):
+        data = bytes(data)
+        with self.lock:
+            start = max(time.monotonic(), self.txFree)
+            self.txFree = start + self.wireTime(len(data))
+            for (response, ready) in self.device.receive(data, self.txFree + self.latency, self.baudrate):
+                self.pending.append([ready + self.wireTime(len(response)) + self.latency, bytearray(response)])
+        return len(data)
+
+    def read(self, size = 1):
+        deadline = time.monotonic() + self.timeout
+        result = bytearray()
+        while len(result) < size:
+            now = time.monotonic()
+            with self.lock:
+                while len(self.pending) > 0 and self.pending[0][0] <= now and len(result) < size:
+                    chunk = self.pending[0][1]
+                    amount = min(size - len(result), len(chunk))
+                    result += chunk[:amount]
+                    del chunk[:amount]
+                    if len(chunk) == 0:
+                        self.pending.pop(0)
+                wake = deadline
+                if len(self.pending) > 0:
+                    wake = min(wake, self.pending[0][0])
+            if len(result) >= size or now >= deadline:
+                break
+            time.sleep(max(0, wake - now))
+        return bytes(result)
+
+    def inWaiting(self):
+        now = time.monotonic()
+        with self.lock:
+            return sum([len(data) for (ready, data) in self.pending if ready <= now])
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def reset_input_buffer(self):
+        with self.lock:
+            self.pending = []
+
+    def close(self):
+        pass
+
+def ptyBaudrate(fd):
+    import termios
+    speed = termios.tcgetattr(fd)[5]
+    for name in dir(termios):
+        if name.startswith("B") and name[1:].isdigit() and getattr(termios, name) == speed:
+            return int(name[1:])
+    return 115200
+
+def servePty(device):
+    # Runs the device behind a pseudo terminal, returns the name of the terminal for bltool to open
+    import pty, tty, select
+    (master, slave) = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    def serve():
+        pending = []
+        lineFree = 0
+        while True:
+            timeout = 0.5
+            if len(pending) > 0:
+                timeout = max(0, pending[0][0] - time.monotonic())
+            (readable, _, _) = select.select([master], [], [], timeout)
+            if master in readable:
+                data = os.read(master, 65536)
+                baudrate = ptyBaudrate(slave)
+                lineFree = max(time.monotonic(), lineFree) + len(data) * 10 / baudrate
+                for (response, ready) in device.receive(data, lineFree, baudrate):
+                    pending.append((ready + len(response) * 10 / baudrate, response))
+                pending.sort(key=lambda item: item[0])
+            while len(pending) > 0 and pending[0][0] <= time.monotonic():
+                os.write(master, pending.pop(0)[1])
+    threading.Thread(target=serve, daemon=True).start()
+    return os.ttyname(slave)
+
+def benchmark(device, args):
+    import bltool
+    port = SimulatedPort(device, args.baudrate, latency=args.latency)
+    reporter = bltool.Reporter("sim")
+    with open(args.image, "rb") as f:
+        data = f.read()
+    with open(bltool.loaderFiles["rc32m"], "rb") as f:
+        loaderBinary = f.read()
+    stages = []
+    def stage(name, function, amount = 0):
+        start = time.monotonic()
+        result = function()
+        stages.append((name, time.monotonic() - start, amount))
+        return result
+    brom = bltool.BootromCommunication(port, False, reporter)
+    eflash = bltool.EflashLoaderCommunication(port, False, reporter)
+    stage("sync", brom.sync)
+    stage("loader", lambda: brom.loadAndRunPreprocessedImage(loaderBinary), len(loaderBinary))
+    stage("negotiate", lambda: eflash.negotiateBaudrate([args.flashBaudrate, args.baudrate]))
+    stage("erase", lambda: eflash.eraseRegion(args.address, len(data)), len(data))
+    stage("write", lambda: eflash.writeFlash(data, args.address, args.pipeline), len(data))
+    mismatches = stage("verify", lambda: eflash.verifyFlash(data, args.address), len(data))
+    stage("read", lambda: eflash.readFlash(args.address, len(data)), len(data))
+    print("")
+    print("{:<12}{:>12}{:>20}".format("Stage", "Time (s)", "Throughput (kB/s)"))
+    print("----------------------------------------------------------------------------------------------------------")
+    for (name, duration, amount) in stages:
+        throughput = "{:.1f}".format(amount / duration / 1024) if amount > 0 and duration > 0 else "-"
+        print("{:<12}{:>12.3f}{:>20}".format(name, duration, throughput))
+    print("{:<12}{:>12.3f}".format("total", sum([duration for (name, duration, amount) in stages])))
+    print("Verification {}".format("passed" if len(mismatches) == 0 else "FAILED"))
+
+def main():
+    parser = argparse.ArgumentParser(description="BL602 device simulator")
+    parser.add_argument("mode", choices=["pty", "benchmark"], help="pty: serve simulated devices on pseudo terminals, benchmark: time a full flash cycle")
+    parser.add_argument("-n", "--devices", dest="devices", type=int, default=1, help="Amount of devices to serve in pty mode")
+    parser.add_argument("-s", "--flash-size", dest="flashSize", type=lambda value: int(value, 0), default=2*1024*1024, help="Flash size in bytes (default: 2 MB)")
+    parser.add_argument("--jedec-id", dest="jedecId", type=lambda value: int(value, 16), default=0xef4015, help="JEDEC ID of the flash chip, hexadecimal (default: ef4015)")
+    parser.add_argument("--max-baudrate", dest="maxBaudrate", type=int, default=2000000, help="Fastest baudrate the simulated UART syncs at")
+    parser.add_argument("--delay", dest="delay", type=float, default=0.0005, help="Processing delay per command in seconds")
+    parser.add_argument("--error-rate", dest="errorRate", type=float, default=0.0, help="Chance that an erase or program command fails")
+    parser.add_argument("--drop-rate", dest="dropRate", type=float, default=0.0, help="Chance that a command gets no response")
+    parser.add_argument("--corrupt-rate", dest="corruptRate", type=float, default=0.0, help="Chance that read data gets corrupted")
+    parser.add_argument("-i", "--image", dest="image", default="testfiles/compare.bin", help="Image to write in benchmark mode")
+    parser.add_argument("-a", "--address", dest="address", type=lambda value: int(value, 0), default=0, help="Address to write the image to in benchmark mode")
+    parser.add_argument("-b", "--baudrate", dest="baudrate", type=int, default=115200, help="Bootrom baudrate in benchmark mode")
+    parser.add_argument("-f", "--flash-baudrate", dest="flashBaudrate", type=int, default=2000000, help="Eflash loader baudrate in benchmark mode")
+    parser.add_argument("-l", "--latency", dest="latency", type=float, default=0.0, help="Link latency in seconds in benchmark mode (USB-serial adapters add about 1 ms)")
+    parser.add_argument("-P", "--pipeline", dest="pipeline", type=int, default=1, help="Amount of program commands to keep in flight in benchmark mode")
+    args = parser.parse_args()
+
+    def createDevice():
+        return SimulatedDevice(args.flashSize, args.maxBaudrate, args.delay, args.errorRate, args.dropRate, args.corruptRate, args.jedecId)
+
+    if args.mode == "benchmark":
+        benchmark(createDevice(), args)
+        return
+
+    for i in range(args.devices):
+        print(servePty(createDevice()), flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -8,17 +8,353 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-import serial, time, argparse
+import serial, time, argparse, hashlib, threading, os, json, binascii, mmap, bisect, struct
 import serial.tools.list_ports as list_ports
+import partitionBinToToml, partitionTomlToBin, generateHeaders, headerSchema
+
+loaderFiles = {
+    "40m": "eflash_loader_40m.bin",
+    "rc32m": "eflash_loader_rc32m.bin",
+}
+
+class Reporter:
+    # Progress output for a single device, prefixed with the device name when several devices are handled at once
+    lock = threading.Lock()
+
+    def __init__(self, name = None):
+        self.name = name
+        self.stage = ""
+        self.steps = 0
+
+    def message(self, text):
+        self.stage = text
+        self.steps = 0
+        with Reporter.lock:
+            if self.name == None:
+                print(text)
+            else:
+                print("[{}] {}".format(self.name, text))
+
+    def step(self, symbol = "."):
+        self.steps += 1
+        if self.name == None:
+            print(symbol, end="", flush=True)
+        elif self.steps % 32 == 0:
+            with Reporter.lock:
+                print("[{}] {} {:d} steps".format(self.name, self.stage, self.steps))
+
+    def end(self):
+        if self.name == None:
+            print("")
+
+class WriteJournal:
+    # Remembers which chunks of a write have been programmed and checked, so an interrupted write can be resumed.
+    # The state goes from new to erasing to erased, the device contents around the write and in the gaps between
+    # its regions are stored before the first sector is erased because they can not be read back after that
+    def __init__(self, directory, portName, regions):
+        # Identified by the regions that are written, the assembled data also holds device contents that change
+        s = hashlib.sha256()
+        for (address, data, name) in regions:
+            s.update(addressLength.pack(address, len(data)))
+            s.update(hashlib.sha256(data).digest())
+        name = "{}-{}-{:08x}.json".format(portName.strip("/").replace("/", "_").replace(":", "_"), s.hexdigest()[:16], regions[0][0])
+        self.filename = os.path.join(directory, name)
+        self.state = "new"
+        self.head = bytes([])
+        self.tail = bytes([])
+        self.gaps = None
+        self.completed = []
+        if os.path.exists(self.filename):
+            with open(self.filename, "r") as f:
+                entry = json.load(f)
+            self.state = entry["state"]
+            self.head = binascii.unhexlify(entry["head"])
+            self.tail = binascii.unhexlify(entry["tail"])
+            if entry["gaps"] != None:
+                self.gaps = [(address, binascii.unhexlify(data)) for (address, data) in entry["gaps"]]
+            self.completed = entry["completed"]
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+    def save(self):
+        entry = {
+            "state": self.state,
+            "head": binascii.hexlify(self.head).decode("ascii"),
+            "tail": binascii.hexlify(self.tail).decode("ascii"),
+            "gaps": None if self.gaps == None else [(address, binascii.hexlify(data).decode("ascii")) for (address, data) in self.gaps],
+            "completed": self.completed
+        }
+        # Replace the file in one go, an interruption must never leave a half written journal behind
+        with open(self.filename + ".tmp", "w") as f:
+            json.dump(entry, f)
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def markErasing(self, head, tail, gaps):
+        # The sector-aligned edges and the gaps are stored before erasing starts, an interrupted erase is resumed with them
+        self.state = "erasing"
+        self.head = head
+        self.tail = tail
+        self.gaps = gaps
+        self.save()
+
+    def markErased(self):
+        self.state = "erased"
+        self.save()
+
+    def reset(self):
+        # After a failed verification none of the written chunks can be trusted, the next run erases
+        # (with the stored edges) and writes everything again
+        if self.state == "erased":
+            self.state = "erasing"
+        self.completed = []
+        self.save()
+
+    def markCompleted(self, addresses):
+        self.completed += addresses
+        self.save()
+
+    def finish(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+class Statistics:
+    # Per-command counts, bytes and latencies of a session, and where its time went
+    latencyBuckets = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10]
+
+    def __init__(self, name = None, trace = False):
+        self.name = name
+        self.start = time.monotonic()
+        self.commands = {}
+        self.time = {"sleeping": 0, "waiting": 0, "transferring": 0}
+        self.stages = {}
+        self.events = None
+        if trace:
+            self.events = []
+
+    def entry(self, name):
+        if not name in self.commands:
+            self.commands[name] = {
+                "count": 0,
+                "errors": 0,
+                "bytesSent": 0,
+                "bytesReceived": 0,
+                "latencyTotal": 0,
+                "latencyMax": 0,
+                "latencyHistogram": [0] * (len(Statistics.latencyBuckets) + 1)
+            }
+        return self.commands[name]
+
+    def addTime(self, category, start, duration, label = None):
+        self.time[category] += duration
+        if self.events != None:
+            self.events.append({"name": label or category, "cat": category, "ph": "X", "tid": category, "ts": (start - self.start) * 1000000, "dur": duration * 1000000})
+
+    def addSent(self, name, amount, start, duration):
+        self.entry(name)["bytesSent"] += amount
+        self.addTime("transferring", start, duration, name)
+
+    def addCommand(self, name, sentAt, amount, failed):
+        latency = time.monotonic() - sentAt
+        entry = self.entry(name)
+        entry["count"] += 1
+        entry["bytesReceived"] += amount
+        if failed:
+            entry["errors"] += 1
+        entry["latencyTotal"] += latency
+        entry["latencyMax"] = max(entry["latencyMax"], latency)
+        entry["latencyHistogram"][bisect.bisect_left(Statistics.latencyBuckets, latency)] += 1
+        if self.events != None:
+            self.events.append({"name": name, "cat": "command", "ph": "X", "tid": "commands", "ts": (sentAt - self.start) * 1000000, "dur": latency * 1000000})
+
+    def addStage(self, name, start):
+        # Wall-clock time of a stage (erase, write, verify...) over all regions
+        self.stages[name] = self.stages.get(name, 0) + time.monotonic() - start
+
+    def summary(self):
+        return {
+            "name": self.name,
+            "duration": time.monotonic() - self.start,
+            "time": dict(self.time),
+            "stages": dict(self.stages),
+            "latencyBuckets": Statistics.latencyBuckets,
+            "commands": self.commands
+        }
+
+    def traceEvents(self, pid):
+        # Chrome trace format, every device is shown as a separate process
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": self.name or "device"}}]
+        for event in self.events or []:
+            event = dict(event)
+            event["pid"] = pid
+            events.append(event)
+        return events
+
+def aggregateStatistics(summaries):
+    # Combines the summaries of several devices (or runs) into one
+    total = {"devices": len(summaries), "duration": 0, "time": {}, "stages": {}, "latencyBuckets": Statistics.latencyBuckets, "commands": {}}
+    for summary in summaries:
+        total["duration"] += summary["duration"]
+        for category in summary["time"]:
+            total["time"][category] = total["time"].get(category, 0) + summary["time"][category]
+        for stage in summary.get("stages", {}):
+            total["stages"][stage] = total["stages"].get(stage, 0) + summary["stages"][stage]
+        for name in summary["commands"]:
+            entry = summary["commands"][name]
+            if not name in total["commands"]:
+                total["commands"][name] = {"count": 0, "errors": 0, "bytesSent": 0, "bytesReceived": 0, "latencyTotal": 0, "latencyMax": 0, "latencyHistogram": [0] * len(entry["latencyHistogram"])}
+            combined = total["commands"][name]
+            for key in ["count", "errors", "bytesSent", "bytesReceived", "latencyTotal"]:
+                combined[key] += entry[key]
+            combined["latencyMax"] = max(combined["latencyMax"], entry["latencyMax"])
+            combined["latencyHistogram"] = [a + b for (a, b) in zip(combined["latencyHistogram"], entry["latencyHistogram"])]
+    return total
+
+# Command header: id, checksum, parameter length
+commandHeader = struct.Struct("<BBH")
+# Flash address followed by a length or end address
+addressLength = struct.Struct("<II")
+flashAddress = struct.Struct("<I")
+
+# The bootloader uses the valid copy of the partition table with the highest age
+partitionTableAddresses = [0xE000, 0xF000]
+
+# Compressed firmware starts with an xz stream header, boot2 unpacks it
+xzMagic = b"\xfd7zXZ\x00"
 
 def openPort(device, baudrate=115200):
     return serial.Serial(device, baudrate, timeout=0.1, xonxoff=False, rtscts=False, write_timeout=None, dsrdtr=False)
 
+def mapFile(filename):
+    # Maps the file instead of reading it into memory, chunks are sent straight from the page cache
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(bytes([]))
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def loadManifest(filename):
+    # Returns the (address, filename) pairs of the regions in a TOML manifest, file names are relative to the manifest
+    import toml
+    manifest = toml.load(filename)
+    directory = os.path.dirname(filename)
+    return [(region["address"], os.path.join(directory, region["file"])) for region in manifest["region"]]
+
+def loadSparse(filename):
+    # Returns (address, data, name) regions for the extents listed in a sparse image description of generateImage.py,
+    # only those are written and the padding between them is skipped
+    with open(filename, "r") as f:
+        sparse = json.load(f)
+    imageName = os.path.join(os.path.dirname(filename), sparse["image"])
+    image = mapFile(imageName)
+    regions = []
+    for extent in sparse["extents"]:
+        data = image[extent["address"]:extent["address"] + extent["length"]]
+        if hashlib.sha256(data).hexdigest() != extent["sha256"]:
+            raise Exception("Image does not match its sparse description", imageName, extent["address"])
+        regions.append((extent["address"], data, "{}:0x{:x}".format(imageName, extent["address"])))
+    return regions
+
+def planRegions(regions, sectorSize = 0x1000):
+    # Sorts (address, data, name) regions and groups the ones that are adjacent or share a sector,
+    # those are erased and written as one
+    groups = []
+    for region in sorted(regions, key=lambda region: region[0]):
+        (address, data, name) = region
+        if len(data) == 0:
+            continue
+        if len(groups) > 0:
+            (lastAddress, lastData, lastName) = groups[-1][-1]
+            end = lastAddress + len(lastData)
+            if end > address:
+                raise Exception("Regions overlap", lastName, name)
+            if end == address or (end + sectorSize - 1) // sectorSize > address // sectorSize:
+                groups[-1].append(region)
+                continue
+        groups.append([region])
+    return groups
+
+def matchFlashConfig(region, flash):
+    # Replaces the flash configuration in the boot header of a region at address 0 with the one of the flash chip
+    (address, data, name) = region
+    size = headerSchema.bootHeader.size
+    if address != 0 or len(data) < size:
+        return region
+    try:
+        header = headerSchema.bootHeader.decode(data[:size], strict = False)
+    except Exception:
+        return region
+    header.flashConfig = headerSchema.flashConfig.create(flash)
+    return (address, header.encode() + data[size:], name)
+
+def findPartition(entries, name):
+    # Returns (address, size) of a partition, "name" is its active slot and "name:1" a specific slot
+    slot = None
+    if ":" in name:
+        (name, slot) = name.split(":")
+        slot = int(slot)
+    for entry in entries:
+        if entry["name"] == name:
+            if slot == None:
+                slot = entry["activeIndex"]
+            if not slot in [0, 1] or entry["size{:d}".format(slot)] == 0:
+                raise Exception("Partition has no such slot", name, slot)
+            return (entry["address{:d}".format(slot)], entry["size{:d}".format(slot)])
+    raise Exception("Partition not found", name, [entry["name"] for entry in entries])
+
+def trimmedLength(data, blockSize = 4096):
+    # Length of the data without the trailing blank (0xFF) bytes, looking at one block at a time from the end
+    end = len(data)
+    while end > 0:
+        start = max(0, end - blockSize)
+        length = len(data[start:end].rstrip(bytes([0xFF])))
+        if length > 0:
+            return start + length
+        end = start
+    return 0
+
+def dataExtents(data, granularity = 256):
+    # Returns (offset, length) pairs for the runs of data that are not blank (0xFF), erased flash already reads as 0xFF
+    blank = bytes([0xFF] * granularity)
+    data = memoryview(data)
+    extents = []
+    start = None
+    for offset in range(0, len(data), granularity):
+        page = data[offset:offset+granularity]
+        if page == blank[:len(page)]:
+            if start != None:
+                extents.append((start, offset - start))
+                start = None
+        elif start == None:
+            start = offset
+    if start != None:
+        extents.append((start, len(data) - start))
+    return extents
+
+def planErase(addr, length, units = [0x10000, 0x8000, 0x1000]):
+    # Rounds the range out to sector boundaries and covers it with the largest aligned erase units that fit
+    sectorSize = units[-1]
+    start = addr - addr % sectorSize
+    end = addr + length
+    end += (sectorSize - end % sectorSize) % sectorSize
+    plan = []
+    while start < end:
+        for size in units:
+            if start % size == 0 and start + size <= end:
+                break
+        plan.append((start, size))
+        start += size
+    return plan
+
 class GenericCommunication:
-    def __init__(self, port, debug = False):
+    def __init__(self, port, debug = False, reporter = None, statistics = None):
         self.commands = {}
         self.port = port
         self.debug = debug
+        self.reporter = reporter
+        if self.reporter == None:
+            self.reporter = Reporter()
+        self.statistics = statistics
+        if self.statistics == None:
+            self.statistics = Statistics()
         
     def sync(self):
         # Flush
@@ -29,7 +365,9 @@ class GenericCommunication:
         self.port.write(syncRequest)
         if self.debug:
             print("SYNC > {}".format(syncRequest))
+        start = time.monotonic()
         time.sleep(0.1)
+        self.statistics.addTime("sleeping", start, time.monotonic() - start, "sync")
         # Check response
         if self.port.inWaiting() == 2:
             answer = self.port.read(2)
@@ -44,19 +382,76 @@ class GenericCommunication:
             print("SYNC < (invalid response type 1) {}".format(self.port.read(1024)))
         return False
 
+    def readExact(self, amount, deadline):
+        # Blocks until the requested amount of bytes has arrived or the deadline has passed
+        data = bytearray()
+        while len(data) < amount and time.monotonic() < deadline:
+            data += self.port.read(amount - len(data))
+        return bytes(data)
+
+    def drain(self):
+        # Discards everything the device sends until the line goes quiet
+        start = time.monotonic()
+        while len(self.port.read(4096)) > 0:
+            pass
+        self.statistics.addTime("sleeping", start, time.monotonic() - start, "drain")
+
+    def transmit(self, cmd, data):
+        start = time.monotonic()
+        self.port.write(data)
+        self.statistics.addSent(cmd["name"], len(data), start, time.monotonic() - start)
+
+    def wireTime(self, amount):
+        # Time it takes to shift the given amount of bytes over the UART (8N1)
+        return amount * 10 / self.port.baudrate
+
+    def readResponse(self, cmd, timeout, sentAt = None):
+        start = time.monotonic()
+        if sentAt == None:
+            sentAt = start
+        (status, answer) = self.readFrame(cmd, start + timeout)
+        self.statistics.addCommand(cmd["name"], sentAt, len(status) + len(answer), status != b"OK")
+        return (status, answer)
+
+    def readFrame(self, cmd, deadline):
+        start = time.monotonic()
+        status = self.readExact(2, deadline)
+        while status == b"PD":
+            # Device is still busy (erasing), keep waiting until the deadline
+            status = self.readExact(2, deadline)
+        received = time.monotonic()
+        self.statistics.addTime("waiting", start, received - start, cmd["name"])
+        if len(status) < 2:
+            raise Exception("No response")
+        if status == b"OK":
+            if not cmd.get("response", False):
+                return (status, bytes([]))
+            lengthField = self.readExact(2, deadline)
+            if len(lengthField) < 2:
+                raise Exception("Incomplete response", lengthField)
+            length = lengthField[0] + (lengthField[1] << 8)
+            payload = self.readExact(length, deadline)
+            self.statistics.addTime("transferring", received, time.monotonic() - received, cmd["name"])
+            if len(payload) < length:
+                raise Exception("Incomplete response", len(payload), length)
+            return (status, lengthField + payload)
+        if status == b"FL":
+            return (status, self.readExact(2, deadline))
+        return (status, bytes([]))
+
 class BootromCommunication(GenericCommunication):
-    def __init__(self, port, debug = False):
-        super(BootromCommunication, self).__init__(port, debug)
+    def __init__(self, port, debug = False, reporter = None, statistics = None):
+        super(BootromCommunication, self).__init__(port, debug, reporter, statistics)
         
         self.commands = {
-            "get_boot_info":    {"id": 0x10, "length": 0x0000},
+            "get_boot_info":    {"id": 0x10, "length": 0x0000, "response": True},
             "load_boot_header": {"id": 0x11, "length": 0x00b0},
             "load_public_key":  {"id": 0x12, "length": 0x0044},
             "load_public_key2": {"id": 0x13, "length": 0x0044},
             "load_signature":   {"id": 0x14, "length": 0x0004},
             "load_signature2":  {"id": 0x15, "length": 0x0004},
             "load_aes_iv":      {"id": 0x16, "length": 0x0014},
-            "load_seg_header":  {"id": 0x17, "length": 0x0010},
+            "load_seg_header":  {"id": 0x17, "length": 0x0010, "response": True},
             "load_seg_data":    {"id": 0x18, "length": 0x0100},
             "check_image":      {"id": 0x19, "length": 0x0000},
             "run_image":        {"id": 0x1a, "length": 0x0000},
@@ -64,48 +459,45 @@ class BootromCommunication(GenericCommunication):
             "reset":            {"id": 0x21, "length": 0x0000},
             "flash_erase":      {"id": 0x30, "length": 0x0000},
             "flash_write":      {"id": 0x31, "length": 0x0100},
-            "flash_read":       {"id": 0x32, "length": 0x0100},
+            "flash_read":       {"id": 0x32, "length": 0x0100, "response": True},
             "flash_boot":       {"id": 0x33, "length": 0x0000},
             "efuse_write":      {"id": 0x40, "length": 0x0080},
-            "efuse_read":       {"id": 0x41, "length": 0x0000},
+            "efuse_read":       {"id": 0x41, "length": 0x0000, "response": True},
         }
+        for name in self.commands:
+            self.commands[name]["name"] = name
 
-    def executeCommand(self, cmd, params=bytes([]), length=None):
+    def executeCommand(self, cmd, params=bytes([]), length=None, timeout=2):
         if cmd in self.commands:
             cmd = self.commands[cmd]
             if length == None:
                 length = cmd["length"]
             if not len(params) == length:
                 raise Exception("Wrong parameter length", len(params), length)
-            command = bytes([cmd["id"], 1, length & 0xFF, length >> 8])
-            self.port.write(command)
+            command = commandHeader.pack(cmd["id"], 1, length)
+            sentAt = time.monotonic()
+            self.transmit(cmd, command)
             if self.debug:
                     print("BOOT > command {}".format(command))
             if length > 0:
-                self.port.write(params)
+                self.transmit(cmd, params)
                 if self.debug:
-                    print("BOOT > parameters {}".format(params))
-            time.sleep(0.1)
-            if self.port.inWaiting() >= 2:
-                answer = self.port.read(2)
-                if answer[0] == ord("O") and answer[1] == ord("K"):
-                    answer = self.port.read(8096)
-                    if self.debug:
-                        print("BOOT < result {}".format(answer))
-                    return answer
-                elif answer[0] == ord("F") and answer[1] == ord("L"):
-                    error = self.port.read(8096)
-                    if self.debug:
-                        print("BOOT < error {}".format(error))
-                    if error == b"\x03\x01":
-                        raise Exception("Device already in EFLASH app, reset board back to BOOTROM then try again")
-                    raise Exception("Bootrom error result", error)
-                else:
-                    if self.debug:
-                        print("BOOT < unhandled {}".format(answer))
-                    raise Exception("Communication error, unhandled response:", answer)
+                    print("BOOT > parameters {}".format(bytes(params)))
+            (status, answer) = self.readResponse(cmd, timeout + self.wireTime(len(command) + length), sentAt)
+            if status == b"OK":
+                if self.debug:
+                    print("BOOT < result {}".format(answer))
+                return answer
+            elif status == b"FL":
+                if self.debug:
+                    print("BOOT < error {}".format(answer))
+                if answer == b"\x03\x01":
+                    raise Exception("Device already in EFLASH app, reset board back to BOOTROM then try again")
+                raise Exception("Bootrom error result", answer)
             else:
-                raise Exception("No response")
+                if self.debug:
+                    print("BOOT < unhandled {}".format(status))
+                raise Exception("Communication error, unhandled response:", status)
         raise Exception("Unknown command")
     
     def getBootInfo(self):
@@ -119,19 +511,30 @@ class BootromCommunication(GenericCommunication):
         result = result[4:]
         return (bootromVersion, result)
     
+    def readCrystal(self):
+        # Returns the crystal type in the clock configuration of the boot header in flash, None when there is no valid one
+        try:
+            data = self.executeCommand("flash_read", addressLength.pack(0, headerSchema.bootHeader.size), 8)[2:]
+            header = headerSchema.bootHeader.decode(bytes(data), False)
+        except Exception as e:
+            if self.debug:
+                print("BOOT < no boot header {}".format(e))
+            return None
+        if not isinstance(header.clockConfig, headerSchema.Record):
+            return None
+        return header.clockConfig.xtalType
+
     def loadBootHeader(self, bootHeader):
-        return self.executeCommand("load_boot_header", bytes(bootHeader))
+        return self.executeCommand("load_boot_header", bootHeader)
     
     def loadSegmentHeader(self, segmentHeader):
-        return self.executeCommand("load_seg_header", bytes(segmentHeader))
+        return self.executeCommand("load_seg_header", segmentHeader)
     
     def loadSegmentData(self, data):
-        while len(data) > 0:
-            length = 4092
-            if len(data) < length:
-                length = len(data)
-            result = self.executeCommand("load_seg_data", bytes(data[:length]), length)
-            data = data[length:]
+        data = memoryview(data)
+        for offset in range(0, len(data), 4092):
+            chunk = data[offset:offset+4092]
+            result = self.executeCommand("load_seg_data", chunk, len(chunk))
     
     def checkImage(self):
         return self.executeCommand("check_image")
@@ -140,183 +543,840 @@ class BootromCommunication(GenericCommunication):
         return self.executeCommand("run_image")
     
     def loadAndRunPreprocessedImage(self, data):
+        data = memoryview(data)
         bootHeader = data[:176]
-        data = data[176:]
-        segHeader = data[:16]
-        data = data[16:]
+        segHeader = data[176:192]
+        data = data[192:]
 
-        print("Sending boot header...")
+        self.reporter.message("Sending boot header...")
         result = self.loadBootHeader(bootHeader)
-        print("Sending segment header...")
+        self.reporter.message("Sending segment header...")
         result = self.loadSegmentHeader(segHeader)
-        print("Writing application to RAM...")
+        self.reporter.message("Writing application to RAM...")
         result = self.loadSegmentData(data)
-        print ("Checking...")
+        self.reporter.message("Checking...")
         _ = self.checkImage()
-        print("Jumping...")
+        self.reporter.message("Jumping...")
         _ = self.runImage()
 
 class EflashLoaderCommunication(GenericCommunication):
-    def __init__(self, port, debug = False):
-        super(EflashLoaderCommunication, self).__init__(port, debug)
+    def __init__(self, port, debug = False, reporter = None, statistics = None):
+        super(EflashLoaderCommunication, self).__init__(port, debug, reporter, statistics)
         
         self.commands = {
-            "chip_erase":    {"id": 0x3C, "length": 0x0000},
+            "chip_erase":    {"id": 0x3C, "length": 0x0000, "timeout": 60},
             "flash_erase":   {"id": 0x30, "length": 0x0008}, # start-addr (4 bytes), end-addr (4 bytes)
             "flash_program": {"id": 0x31, "length": 0x0004}, # length = n+4, params: start-addr (4 bytes), payload (n bytes)
             "flash_check":   {"id": 0x3A, "length": 0x0000},
-            "flash_read":    {"id": 0x32, "length": 0x0008}, # length = n+4, params: start-addr (4 bytes), read-length (4 bytes)
-            "sha256_read":   {"id": 0x3D, "length": 0x0008}, # length = n+4, params: start-addr (4 bytes), read-length (4 bytes)
+            "flash_read":    {"id": 0x32, "length": 0x0008, "response": True}, # length = n+4, params: start-addr (4 bytes), read-length (4 bytes)
+            "sha256_read":   {"id": 0x3D, "length": 0x0008, "response": True}, # length = n+4, params: start-addr (4 bytes), read-length (4 bytes)
+            "flash_read_jid": {"id": 0x36, "length": 0x0000, "response": True},
+        }
+        for name in self.commands:
+            self.commands[name]["name"] = name
+
+        # Slower baudrates to drop back to when communication fails
+        self.fallbackBaudrates = []
+
+        # Largest amount of data the loader returns for a single flash_read, determined on first use
+        self.readSize = None
+
+        # Erase unit size and how long to wait for it to complete (seconds)
+        self.eraseTimeouts = {
+            0x10000: 3,
+            0x8000:  2,
+            0x1000:  1,
         }
 
-    def executeCommand(self, cmd, params=bytes([]), length=None, timeout=1, expectAmount=8096):
+        # Presets of known flash chips, by JEDEC ID
+        self.flashConfigs = generateHeaders.FlashConfig()
+
+    def sendCommand(self, cmd, params=bytes([]), length=None, timeout=None, payload=bytes([])):
+        # The payload is sent after the parameters without copying it into one buffer first
         if cmd in self.commands:
             cmd = self.commands[cmd]
             if length == None:
                 length = cmd["length"]
-            if not len(params) == length:
-                raise Exception("Wrong parameter length", len(params), length)
-            chksum = 0
-            chksum += length & 0xFF
-            chksum += length >> 8
-            for i in range(len(params)):
-                chksum += params[i]
-            chksum = chksum & 0xFF
-            command = bytes([cmd["id"], chksum, length & 0xFF, length >> 8])
-            self.port.write(command)
+            if timeout == None:
+                timeout = cmd.get("timeout", 2)
+            if not len(params) + len(payload) == length:
+                raise Exception("Wrong parameter length", len(params) + len(payload), length)
+            chksum = ((length & 0xFF) + (length >> 8) + sum(params) + sum(payload)) & 0xFF
+            command = commandHeader.pack(cmd["id"], chksum, length)
+            sentAt = time.monotonic()
+            self.transmit(cmd, command + params)
             if self.debug:
                     print("TOOL > command {}".format(command))
-            if length > 0:
-                self.port.write(params)
+                    if len(params) > 0:
+                        print("TOOL > parameters {}".format(bytes(params)))
+            if len(payload) > 0:
+                self.transmit(cmd, payload)
                 if self.debug:
-                    print("TOOL > parameters {}".format(params))
-            time.sleep(0.1)
-            while timeout > 1 and self.port.inWaiting() < 2:
-                time.sleep(0.1)
-                timeout -= 1
-            if self.port.inWaiting() >= 2:
-                answer = self.port.read(2)
-                if answer[0] == ord("O") and answer[1] == ord("K"):
-                    answer = self.port.read(expectAmount)
-                    if self.debug:
-                        print("TOOL < result {}".format(answer))
-                    return answer
-                elif answer[0] == ord("F") and answer[1] == ord("L"):
-                    error = self.port.read(8096)
-                    if self.debug:
-                        print("TOOL < error {}".format(error))
-                    raise Exception("Eflash error result", error)
-                else:
-                    if self.debug:
-                        print("BOOT < unhandled {}".format(answer))
-                    raise Exception("Communication error, unhandled response:", answer)
-            else:
-                raise Exception("No response")
+                    print("TOOL > payload {}".format(bytes(payload)))
+            return (cmd, timeout + self.wireTime(len(command) + length), sentAt)
         raise Exception("Unknown command")
+
+    def receiveResult(self, request):
+        (status, answer) = self.readResponse(*request)
+        return self.checkResult(status, answer)
+
+    def checkResult(self, status, answer):
+        if status == b"OK":
+            if self.debug:
+                print("TOOL < result {}".format(answer))
+            return answer
+        elif status == b"FL":
+            if self.debug:
+                print("TOOL < error {}".format(answer))
+            raise Exception("Eflash error result", answer)
+        else:
+            if self.debug:
+                print("TOOL < unhandled {}".format(status))
+            raise Exception("Communication error, unhandled response:", status)
+
+    def executeCommand(self, cmd, params=bytes([]), length=None, timeout=None, retries=3):
+        # A missing or garbled response is retried at the same baudrate, only when that keeps failing the link
+        # drops back to a slower baudrate. Errors reported by the device (FL) are raised right away.
+        failures = 0
+        while True:
+            request = self.sendCommand(cmd, params, length, timeout)
+            try:
+                (status, answer) = self.readResponse(*request)
+            except Exception as e:
+                (status, answer) = (None, e)
+            if status in [b"OK", b"FL"]:
+                return self.checkResult(status, answer)
+            if self.debug:
+                print("TOOL < link error {}".format(status if status != None else answer))
+            failures += 1
+            if failures < retries:
+                # All eflash loader commands can safely be repeated
+                self.drain()
+                self.sync()
+            elif self.fallBack():
+                failures = 0
+            elif status == None:
+                raise answer
+            else:
+                return self.checkResult(status, answer)
+
+    def retryCommand(self, cmd, params, length, timeout, retries = 3):
+        # Repeats a command that the device rejected, for the commands that do the same every time (erase, hash and read)
+        for attempt in range(retries):
+            try:
+                return self.executeCommand(cmd, params, length, timeout)
+            except Exception as e:
+                if attempt == retries - 1:
+                    raise
+                if self.debug:
+                    print("TOOL < retrying {} {}".format(cmd, e))
+                self.drain()
+
+    def probeLink(self, length = 512, rounds = 4):
+        # Reads flash and checks it against the hash calculated by the device, without retrying failed commands
+        try:
+            for i in range(rounds):
+                data = self.executeCommand("flash_read", addressLength.pack(0, length), 8, None, 1)[2:]
+                if len(data) != length or hashlib.sha256(data).digest() != self.executeCommand("sha256_read", addressLength.pack(0, length), 8, None, 1)[2:]:
+                    return False
+        except Exception as e:
+            if self.debug:
+                print("TOOL < probe failed {}".format(e))
+            return False
+        return True
+
+    def switchBaudrate(self, baudrate):
+        self.drain()
+        self.port.baudrate = baudrate
+        # The eflash loader detects the baudrate from the sync pattern
+        return self.sync() and self.probeLink()
+
+    def negotiateBaudrate(self, baudrates):
+        # Stays at the fastest baudrate that passes the link-quality probe
+        self.fallbackBaudrates = []
+        for i in range(len(baudrates)):
+            if self.switchBaudrate(baudrates[i]):
+                self.fallbackBaudrates = baudrates[i+1:]
+                return baudrates[i]
+        raise Exception("Eflash loader does not respond at any baudrate", baudrates)
+
+    def detectLoader(self, baudrates):
+        # Looks for an eflash loader that is still running, returns ("loader", baudrate) when it answers,
+        # ("bootrom", baudrate) when the bootrom answers after completing its handshake and (None, None) otherwise
+        for baudrate in baudrates:
+            self.drain()
+            self.port.baudrate = baudrate
+            if not self.sync():
+                continue
+            # The bootrom does not know sha256_read and answers it with an error
+            request = self.sendCommand("sha256_read", addressLength.pack(0, 32))
+            try:
+                (status, answer) = self.readResponse(*request)
+            except Exception as e:
+                if self.debug:
+                    print("TOOL < no loader {}".format(e))
+                continue
+            if status != b"OK":
+                return ("bootrom", baudrate)
+            if self.probeLink():
+                return ("loader", baudrate)
+        return (None, None)
+
+    def isAlive(self):
+        # Checks that the loader still answers at the current baudrate, without dropping back to another one
+        request = self.sendCommand("sha256_read", addressLength.pack(0, 32))
+        try:
+            (status, answer) = self.readResponse(*request)
+        except Exception:
+            return False
+        return status == b"OK"
+
+    def fallBack(self):
+        # Drops back to the next slower baudrate that passes the probe after a communication error
+        while len(self.fallbackBaudrates) > 0:
+            baudrate = self.fallbackBaudrates.pop(0)
+            remaining = self.fallbackBaudrates
+            self.fallbackBaudrates = []
+            working = self.switchBaudrate(baudrate)
+            self.fallbackBaudrates = remaining
+            if working:
+                self.reporter.message("Communication errors, dropped back to {:d} baud".format(baudrate))
+                return True
+        return False
     
     def eraseFlash(self):
-        return self.executeCommand("chip_erase", bytes([]), None, 100)
-    
-    def writeFlash(self, data, addr = 0):
-        while len(data[addr:]) > 0:
-            length = 4092
-            if len(data[addr:]) < length:
-                length = len(data[addr:])
-            #print("Writing... Addr = " + str(addr) + ", Length remaining = " + str(len(data[addr:])), flush=True)
-            print(".", end="", flush=True)
-            result = self.executeCommand("flash_program", bytes([addr & 0xFF, (addr>>8)&0xFF, (addr>>16)&0xFF, (addr>>24)&0xFF])+bytes(data[addr:addr+length]), length + 4, 100)
-            addr += length
-            _ = self.executeCommand("flash_check", bytes([]), None, 100)
-        print("")
+        return self.executeCommand("chip_erase")
+
+    def eraseRegion(self, addr, length):
+        # Erases all sectors touched by the range, using the largest erase units that fit
+        units = sorted(self.eraseTimeouts.keys(), reverse=True)
+        for (start, size) in planErase(addr, length, units):
+            # The end address of flash_erase is inclusive
+            end = start + size - 1
+            _ = self.retryCommand("flash_erase", addressLength.pack(start, end), 8, self.eraseTimeouts[size])
+            self.reporter.step()
+        self.reporter.end()
+
+    def sendProgram(self, addr, data):
+        return self.sendCommand("flash_program", flashAddress.pack(addr), len(data) + 4, 10, data)
+
+    def programChunk(self, addr, data, retries = 3):
+        # Stop-and-wait: program a single chunk and wait for the write to complete
+        for attempt in range(retries):
+            try:
+                self.receiveResult(self.sendProgram(addr, data))
+                _ = self.executeCommand("flash_check", bytes([]), None, 10)
+                return
+            except Exception as e:
+                if attempt == retries - 1:
+                    raise Exception("Failed to program chunk at 0x{:08x}".format(addr), e)
+                self.reporter.step("!")
+                self.drain()
+                self.sync()
+
+    def programWindow(self, chunks, inFlight):
+        # Keeps up to inFlight program commands on the wire, responses arrive in the order the commands were sent
+        # Returns the chunks that have to be programmed again
+        pending = []
+        failed = []
+        index = 0
+        while index < len(chunks) or len(pending) > 0:
+            while index < len(chunks) and len(pending) < inFlight:
+                (addr, data) = chunks[index]
+                pending.append((addr, data, self.sendProgram(addr, data)))
+                index += 1
+            (addr, data, request) = pending.pop(0)
+            try:
+                (status, answer) = self.readResponse(*request)
+            except Exception as e:
+                (status, answer) = (None, e)
+            if status == b"OK":
+                self.reporter.step()
+            elif status == b"FL":
+                # The device rejected this chunk, the responses of the other chunks are still in order
+                if self.debug:
+                    print("TOOL < error {}".format(answer))
+                self.reporter.step("!")
+                failed.append((addr, data))
+            else:
+                # A response went missing or got garbled, which means earlier responses
+                # may have been attributed to the wrong chunk as well
+                if self.debug:
+                    print("TOOL < unhandled {}".format(answer))
+                self.reporter.step("!")
+                self.drain()
+                return chunks
+        try:
+            _ = self.executeCommand("flash_check", bytes([]), None, 10)
+        except Exception:
+            self.drain()
+            return chunks
+        return failed
+
+    def programChunks(self, chunks, inFlight = 1, window = 16, journal = None):
+        # Writes are confirmed with a single flash_check per window of chunks
+        for index in range(0, len(chunks), window):
+            for (addr, data) in self.programWindow(chunks[index:index+window], inFlight):
+                # Fall back to stop-and-wait for the chunks that did not make it
+                self.programChunk(addr, data)
+                self.reporter.step()
+            if journal != None:
+                journal.markCompleted([addr for (addr, data) in chunks[index:index+window]])
+
+    def confirmChunks(self, chunks, journal, amount = 4):
+        # The chunks written last before an interruption are checked against the device again
+        lookup = dict(chunks)
+        for addr in journal.completed[-amount:]:
+            if addr in lookup and self.readHash(addr, len(lookup[addr])) != hashlib.sha256(lookup[addr]).digest():
+                journal.completed.remove(addr)
+
+    def writeFlash(self, data, addr = 0, inFlight = 1, skipBlank = True, journal = None):
+        # Chunks are views into the data, nothing is copied until it is written to the port
+        data = memoryview(data)
+        if skipBlank:
+            extents = dataExtents(data)
+        else:
+            extents = [(0, len(data))]
+        chunks = []
+        for (start, amount) in extents:
+            offset = start
+            while offset < start + amount:
+                length = 4092
+                if start + amount - offset < length:
+                    length = start + amount - offset
+                chunks.append((addr + offset, data[offset:offset+length]))
+                offset += length
+        if journal != None and len(journal.completed) > 0:
+            self.confirmChunks(chunks, journal)
+            completed = set(journal.completed)
+            self.reporter.message("Resuming, {:d} of {:d} chunks were already written".format(len([chunk for chunk in chunks if chunk[0] in completed]), len(chunks)))
+            chunks = [chunk for chunk in chunks if not chunk[0] in completed]
+        self.programChunks(chunks, inFlight, 16, journal)
+        self.reporter.end()
+        skipped = len(data) - sum([amount for (start, amount) in extents])
+        if skipped > 0:
+            self.reporter.message("Skipped {:d} blank bytes".format(skipped))
     
+    def readBlock(self, addr, length):
+        result = self.retryCommand("flash_read", addressLength.pack(addr, length), 8, 2 + self.wireTime(length))
+        return result[2:]
+
+    def findReadSize(self, sizes = [4096, 2048, 1024, 512]):
+        # Asks for increasingly smaller reads until the loader answers one in full
+        for length in sizes:
+            request = self.sendCommand("flash_read", addressLength.pack(0, length), 8, 2 + self.wireTime(length))
+            try:
+                (status, answer) = self.readResponse(*request)
+                if status == b"OK" and len(answer[2:]) == length:
+                    return length
+            except Exception:
+                pass
+            self.drain()
+        raise Exception("Eflash loader does not answer flash reads")
+
+    def readFlashInto(self, addr, buffer):
+        # Fills a preallocated buffer (or a memory mapped file) with flash contents
+        if self.readSize == None:
+            self.readSize = self.findReadSize()
+        view = memoryview(buffer)
+        position = 0
+        attempts = 0
+        while position < len(view):
+            length = min(self.readSize, len(view) - position)
+            result = self.readBlock(addr + position, length)[:length]
+            if len(result) < length:
+                # Short read, the remainder is requested again
+                self.reporter.step("!")
+                attempts += 1
+                if attempts > 3:
+                    raise Exception("Read wrong amount", addr + position, len(result), length)
+            else:
+                self.reporter.step()
+                attempts = 0
+            view[position:position+len(result)] = result
+            position += len(result)
+        self.reporter.end()
+        view.release()
+
     def readFlash(self, addr = 0, amount = 4096):
-        data = bytes([])
-        while amount > 0:
-            length = 512
-            if amount < length:
-                length = amount
-            #print("Reading... Addr = " + str(addr) + ", Length remaining = " + str(amount), flush=True)
-            print(".", end="", flush=True)
-            result = self.executeCommand("flash_read", bytes([addr & 0xFF, (addr>>8)&0xFF, (addr>>16)&0xFF, (addr>>24)&0xFF])+bytes([length & 0xFF, (length>>8)&0xFF, (length>>16)&0xFF, (length>>24)&0xFF]), 8, 100, length+10)
-            if result == None:
-                raise Exception("Read without result")
-            if len(result[2:]) != length:
-                print("!", end="", flush=True)
-            #    raise Exception("Read wrong amount", len(result[2:]), length)
-            data += result[2:]
-            addr += len(result[2:])
-            amount -= len(result[2:])
-        print("")
+        data = bytearray(amount)
+        self.readFlashInto(addr, data)
         return data
 
+    def readHash(self, addr, length):
+        result = self.retryCommand("sha256_read", addressLength.pack(addr, length), 8, 2 + length / 0x40000)
+        if len(result[2:]) != 32:
+            raise Exception("Wrong hash length", len(result[2:]))
+        return result[2:]
+
+    def readJedecId(self):
+        result = self.executeCommand("flash_read_jid")
+        if len(result[2:]) < 3:
+            raise Exception("Wrong JEDEC ID length", len(result[2:]))
+        return (result[2] << 16) | (result[3] << 8) | result[4]
+
+    def detectFlashChip(self):
+        # Reads the JEDEC ID of the flash chip and returns its flash configuration, None when the chip is not known
+        jedecId = self.readJedecId()
+        if not jedecId in self.flashConfigs.flashChips:
+            self.reporter.message("Flash chip 0x{:06x} is not known, using the default erase timeouts".format(jedecId))
+            return None
+        config = self.flashConfigs.forJedecId(jedecId)
+        self.reporter.message("Flash chip {} (0x{:06x})".format(self.flashConfigs.flashChips[jedecId], jedecId))
+        # Twice the worst case erase time of the chip, instead of timeouts that fit every chip
+        self.eraseTimeouts = {
+            0x10000: config["timeE64k"] * 2 / 1000,
+            0x8000:  config["timeE32k"] * 2 / 1000,
+            0x1000:  config["timeEsector"] * 2 / 1000,
+        }
+        return config
+
+    def differingRanges(self, data, addr, blockSizes = [0x10000, 0x1000]):
+        # Compares the device against the data using hashes, starting with large blocks and
+        # only descending into the blocks that differ. Returns (offset, length) pairs.
+        ranges = [(0, len(data))]
+        for blockSize in blockSizes:
+            differing = []
+            for (start, amount) in ranges:
+                for offset in range(start, start + amount, blockSize):
+                    length = min(blockSize, start + amount - offset)
+                    if self.readHash(addr + offset, length) != hashlib.sha256(data[offset:offset+length]).digest():
+                        differing.append((offset, length))
+            ranges = differing
+        return ranges
+
+    def verifyFlash(self, data, addr = 0):
+        # Only the sectors whose hash differs are read back, to find the exact failing offsets
+        # Returns (address, expected, actual) for the first mismatching byte in each differing sector
+        mismatches = []
+        for (offset, length) in self.differingRanges(data, addr):
+            verifyData = self.readFlash(addr + offset, length)
+            for i in range(length):
+                if data[offset + i] != verifyData[i]:
+                    mismatches.append((addr + offset + i, data[offset + i], verifyData[i]))
+                    break
+        return mismatches
+
+    def assembleRegions(self, regions, keep = True, gaps = None):
+        # Combines a group of regions into one buffer, the gaps between them keep the current device contents,
+        # or the given (address, data) gaps when those were stored earlier. Returns (data, address, gaps)
+        if len(regions) == 1:
+            return (regions[0][1], regions[0][0], [])
+        start = regions[0][0]
+        end = regions[-1][0] + len(regions[-1][1])
+        data = bytearray([0xFF]) * (end - start)
+        view = memoryview(data)
+        stored = dict(gaps or [])
+        found = []
+        position = start
+        for (address, regionData, name) in regions:
+            if address > position and keep:
+                if position in stored:
+                    view[position-start:address-start] = stored[position]
+                else:
+                    self.readFlashInto(position, view[position-start:address-start])
+                found.append((position, bytes(view[position-start:address-start])))
+            view[address-start:address-start+len(regionData)] = regionData
+            position = address + len(regionData)
+        return (data, start, found)
+
+    def alignToSectors(self, data, addr, sectorSize = 0x1000):
+        # Extends the data with the current device contents up to sector boundaries, so whole sectors can be erased
+        head = addr % sectorSize
+        tail = (sectorSize - (addr + len(data)) % sectorSize) % sectorSize
+        if head == 0 and tail == 0:
+            return (data, addr)
+        aligned = bytearray(head + len(data) + tail)
+        view = memoryview(aligned)
+        aligned[head:head+len(data)] = data
+        if head > 0:
+            self.readFlashInto(addr - head, view[:head])
+        if tail > 0:
+            self.readFlashInto(addr + len(data), view[head+len(data):])
+        return (aligned, addr - head)
+
+    def readPartitionTables(self):
+        # Returns (address, header, entries) for the valid partition table copies
+        tables = []
+        for address in partitionTableAddresses:
+            try:
+                (header, entries) = partitionBinToToml.parsePartitionTable(self.readFlash(address, 0x1000))
+            except Exception as e:
+                self.reporter.message("No valid partition table at 0x{:08x}: {}".format(address, e.args[0]))
+                continue
+            tables.append((address, header, entries))
+        return tables
+
+    def readPartitionTable(self):
+        # Returns (address, header, entries) of the partition table copy the bootloader uses
+        tables = self.readPartitionTables()
+        if len(tables) < 1:
+            raise Exception("No valid partition table found on the device")
+        return max(tables, key=lambda table: table[1]["age"])
+
+    def planOta(self, data, name):
+        # Places the firmware in the FW slot that is not active and prepares the table that switches to it,
+        # returns the region to write and the (address, table) to write after it was verified
+        (address, header, entries) = self.readPartitionTable()
+        firmware = [entry for entry in entries if entry["type"] == 0]
+        if len(firmware) != 1:
+            raise Exception("The partition table does not contain a FW partition")
+        entry = firmware[0]
+        slot = 1 - entry["activeIndex"]
+        (slotAddress, slotSize) = (entry["address{:d}".format(slot)], entry["size{:d}".format(slot)])
+        if slotSize == 0:
+            raise Exception("The FW partition has no second slot")
+        if len(data) > slotSize:
+            raise Exception("The firmware does not fit in FW slot {:d}".format(slot), len(data), slotSize)
+        self.reporter.message("Active FW slot is {:d} (partition table age {:d} at 0x{:08x}), writing slot {:d} at 0x{:08x}".format(entry["activeIndex"], header["age"], address, slot, slotAddress))
+        entry["activeIndex"] = slot
+        entry["age"] += 1
+        # Boot2 needs the length of compressed firmware, uncompressed firmware leaves it at 0
+        entry["len"] = 0
+        if bytes(data[:len(xzMagic)]) == xzMagic:
+            entry["len"] = len(data)
+            self.reporter.message("Firmware is compressed, setting the FW partition length to {:d} bytes".format(len(data)))
+        # The other copy is replaced, the current table stays intact until the new one is complete
+        otherAddress = [other for other in partitionTableAddresses if other != address][0]
+        table = partitionTomlToBin.packPartitionTable(entries, header["version"], header["age"] + 1)
+        return ((slotAddress, data, name), (otherAddress, table))
+
+    def writeFlashDifferential(self, data, addr = 0, inFlight = 1, skipBlank = True, sectorSize = 0x1000):
+        (data, addr) = self.alignToSectors(data, addr, sectorSize)
+        ranges = self.differingRanges(data, addr, [0x10000, sectorSize])
+        runs = []
+        for (offset, length) in ranges:
+            if len(runs) > 0 and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1] = (runs[-1][0], runs[-1][1] + length)
+            else:
+                runs.append((offset, length))
+        self.reporter.message("{:d} of {:d} sectors differ".format(sum([length for (offset, length) in runs]) // sectorSize, len(data) // sectorSize))
+        for (offset, length) in runs:
+            self.eraseRegion(addr + offset, length)
+            self.writeFlash(data[offset:offset+length], addr + offset, inFlight, skipBlank)
+
+def flashDevice(portName, args, reporter, statistics = None):
+    # Runs all requested actions on a single device, returns False when verification failed
+    passed = True
+    start = time.monotonic()
+    port = openPort(portName, args.baudrate[0])
+    eflash = startSession(port, args, reporter, statistics, args.erase or len(args.regions) > 0 or args.read or args.ota or args.readPartitions)
+    if eflash != None:
+        eflash.statistics.addStage("loader", start)
+        passed = runActions(eflash, portName, args)
+    port.close()
+    return passed
+
+def startSession(port, args, reporter, statistics = None, useLoader = True):
+    # Gets an eflash loader running on the open port, or only talks to the bootrom when useLoader is False
+    # Returns the eflash loader communication or None
+    brom = BootromCommunication(port, args.logging, reporter, statistics)
+    eflash = EflashLoaderCommunication(port, args.logging, reporter, statistics)
+
+    if args.flashBaudrate[0] == "auto":
+        baudrates = [2000000, 1000000, 460800]
+    else:
+        baudrates = [int(args.flashBaudrate[0])]
+    # Always end with the speed that is known to work
+    baudrates = [rate for rate in baudrates if rate > args.baudrate[0]] + [args.baudrate[0]]
+
+    # An eflash loader left running by an earlier invocation is used again instead of uploading it,
+    # the bootrom speed is tried first so a board in the bootrom never sees another baudrate
+    (found, foundBaudrate) = (None, None)
+    if (useLoader or args.info) and not args.reload:
+        (found, foundBaudrate) = eflash.detectLoader([args.baudrate[0]] + baudrates[:-1])
+    loaderBaudrate = foundBaudrate if found == "loader" else None
+    if found == None or (found == "bootrom" and foundBaudrate != args.baudrate[0]):
+        # The bootrom is already in command mode when it answered the detection at the bootrom speed
+        port.baudrate = args.baudrate[0]
+        if not brom.sync():
+            raise Exception("The bootrom does not respond", args.baudrate[0])
+    
+    if args.info:
+        if loaderBaudrate != None:
+            reporter.message("The eflash loader is running, reset the board to read OTP information")
+        else:
+            result = brom.getBootInfo()
+            otpFlags = []
+            for y in range(4):
+                otpFlags.append(" ".join(["{:08b}".format(result[1][x+y*4]) for x in range(4)]))
+            reporter.message("BootROM version: {:d}\nOTP flags:\n{}".format(result[0], "\n".join(otpFlags)))
+    
+    if not useLoader:
+        return None
+    if loaderBaudrate != None:
+        baudrate = eflash.negotiateBaudrate(baudrates)
+        reporter.message("Using the eflash loader that is already running, communicating at {:d} baud".format(baudrate))
+    else:
+        loader = args.loader[0]
+        if loader == "auto":
+            # The internal RC oscillator is not accurate enough for high baudrates, the 40 MHz crystal is. The 40m loader
+            # does not run without that crystal, so it is only used when the boot header in flash says the board has one
+            loader = "rc32m"
+            if baudrates[0] > 115200 and brom.readCrystal() == generateHeaders.ClockConfig().xtalTypes["40M"]:
+                loader = "40m"
+            reporter.message("Using the {} eflash loader".format(loader))
+        with open(loaderFiles[loader], "rb") as loaderFile:
+            loaderBinary = loaderFile.read()
+        brom.loadAndRunPreprocessedImage(loaderBinary)
+        baudrate = eflash.negotiateBaudrate(baudrates)
+        reporter.message("Communicating with the eflash loader at {:d} baud".format(baudrate))
+    return eflash
+
+def runActions(eflash, portName, args):
+    # Erases, writes, verifies and reads using a running eflash loader, returns False when verification failed
+    reporter = eflash.reporter
+    passed = True
+    groups = args.regions
+    switch = None
+    flash = eflash.detectFlashChip()
+    if args.matchFlash:
+        if flash == None:
+            raise Exception("Can not match the boot header to a flash chip that is not known")
+        groups = [[matchFlashConfig(region, flash) for region in group] for group in groups]
+    if args.ota:
+        (region, switch) = eflash.planOta(mapFile(args.ota[0]), args.ota[0])
+        groups = planRegions([region for group in groups for region in group] + [region])
+    # Verifying only never erases, not even with -e
+    chipErase = args.erase and not args.verifyOnly
+    writes = []
+    for group in groups:
+        journal = None
+        if args.journal and not (args.differential or args.verifyOnly):
+            journal = WriteJournal(args.journal[0], portName, group)
+        # Once erasing started the gaps between the regions only exist in the journal
+        (data, address, gaps) = eflash.assembleRegions(group, not chipErase, journal.gaps if journal != None else None)
+        writes.append({"name": " + ".join([region[2] for region in group]), "address": address, "data": data, "gaps": gaps, "journal": journal})
+    journals = [write["journal"] for write in writes if write["journal"] != None]
+    
+    if chipErase and not (len(journals) > 0 and all([journal.state == "erased" for journal in journals])):
+        start = time.monotonic()
+        reporter.message("Erasing flash...")
+        eflash.eraseFlash()
+        for journal in journals:
+            journal.markErasing(bytes([]), bytes([]), [])
+            journal.markErased()
+        eflash.statistics.addStage("erase", start)
+    
+    if len(writes) > 0 and not (args.differential or args.verifyOnly):
+        start = time.monotonic()
+        for write in writes:
+            (data, address, journal) = (write["data"], write["address"], write["journal"])
+            if journal != None and journal.state == "erased":
+                (write["data"], write["address"]) = (journal.head + data + journal.tail, address - len(journal.head))
+            elif not (chipErase or args.noErase):
+                if journal != None and journal.state == "erasing":
+                    # An earlier run stopped while erasing, the edges it stored are used instead of reading erased sectors
+                    (alignedData, alignedAddress) = (journal.head + data + journal.tail, address - len(journal.head))
+                else:
+                    # Sectors are erased as a whole, keep the existing data around the file
+                    (alignedData, alignedAddress) = eflash.alignToSectors(data, address)
+                    if journal != None:
+                        journal.markErasing(bytes(alignedData[:address - alignedAddress]), bytes(alignedData[address - alignedAddress + len(data):]), write["gaps"])
+                reporter.message("Erasing 0x{:08x} - 0x{:08x}...".format(alignedAddress, alignedAddress + len(alignedData)))
+                eflash.eraseRegion(alignedAddress, len(alignedData))
+                if journal != None:
+                    journal.markErased()
+                (write["data"], write["address"]) = (alignedData, alignedAddress)
+        eflash.statistics.addStage("erase", start)
+
+    if len(writes) > 0 and not args.verifyOnly:
+        start = time.monotonic()
+        for write in writes:
+            reporter.message("Writing file {} to address 0x{:08x}...".format(write["name"], write["address"]))
+            if args.differential:
+                eflash.writeFlashDifferential(write["data"], write["address"], args.pipeline[0], not args.writeBlank)
+            else:
+                reporter.message("Programming...")
+                eflash.writeFlash(write["data"], write["address"], args.pipeline[0], not args.writeBlank, write["journal"])
+        eflash.statistics.addStage("write", start)
+
+    if (args.verify or args.verifyOnly or switch != None) and len(writes) > 0:
+        start = time.monotonic()
+        reporter.message("Verifying...")
+        for write in writes:
+            mismatches = eflash.verifyFlash(write["data"], write["address"])
+            for (mismatchAddress, expected, actual) in mismatches:
+                reporter.message("Verification failed, mismatch at address 0x{:08x}: {:02x} != {:02x}".format(mismatchAddress, expected, actual))
+            if len(mismatches) > 0:
+                passed = False
+                if write["journal"] != None:
+                    write["journal"].reset()
+                    write["journal"] = None
+        if passed:
+            reporter.message("Verified!")
+        eflash.statistics.addStage("verify", start)
+    # The journals of writes that failed verification were reset above and stay for the next run
+    for write in writes:
+        if write["journal"] != None:
+            write["journal"].finish()
+
+    if switch != None and passed and not args.verifyOnly:
+        (address, table) = switch
+        reporter.message("Switching to the new firmware, writing partition table to 0x{:08x}...".format(address))
+        eflash.eraseRegion(address, 0x1000)
+        eflash.writeFlash(table, address)
+        if eflash.readHash(address, len(table)) != hashlib.sha256(table).digest():
+            raise Exception("Failed to write the partition table", address)
+        
+    if args.read or args.readPartitions:
+        start = time.monotonic()
+        reads = []
+        if args.read:
+            reads.append((int(args.read[0]), int(args.read[1]), args.read[2]))
+        if args.readPartitions:
+            (tableAddress, header, entries) = eflash.readPartitionTable()
+            for name in args.readPartitions:
+                (address, length) = findPartition(entries, name)
+                reads.append((address, length, os.path.join(args.partitionDirectory[0], name.replace(":", "_") + ".bin")))
+        for (address, length, filename) in reads:
+            if reporter.name != None:
+                # Every device gets its own file
+                filename = "{}.{}".format(filename, reporter.name.replace("/", "_"))
+            reporter.message("Reading {:d} bytes from address 0x{:08x} to file {}...".format(length, address, filename))
+            with open(filename, "wb+") as f:
+                if length > 0:
+                    # The flash contents go straight into the file, without keeping a copy in memory
+                    f.truncate(length)
+                    with mmap.mmap(f.fileno(), length) as output:
+                        eflash.readFlashInto(address, output)
+                        if args.trim:
+                            length = trimmedLength(output)
+                    if args.trim:
+                        f.truncate(length)
+                        reporter.message("Trimmed to {:d} bytes".format(length))
+        eflash.statistics.addStage("read", start)
+
+    stages = eflash.statistics.stages
+    reporter.message("Time per stage: " + ", ".join(["{} {:.2f}s".format(stage, stages[stage]) for stage in stages]))
+    return passed
+
+def findPorts(usbIds):
+    # Returns the serial ports of all USB devices matching the VID:PID pairs
+    found = []
+    for usbId in usbIds:
+        (vid, pid) = [int(value, 16) for value in usbId.split(":")]
+        found += [port.device for port in list_ports.comports() if port.vid == vid and port.pid == pid]
+    return sorted(set(found))
+
+def flashDevices(portNames, args, statistics):
+    # Handles every device in its own thread, returns a (port, passed, error, duration) tuple per device
+    results = {}
+    def worker(portName):
+        start = time.monotonic()
+        try:
+            passed = flashDevice(portName, args, Reporter(portName), statistics[portName])
+            results[portName] = (portName, passed, None, time.monotonic() - start)
+        except Exception as e:
+            results[portName] = (portName, False, e, time.monotonic() - start)
+    threads = [threading.Thread(target=worker, args=(portName,)) for portName in portNames]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [results[portName] for portName in portNames]
+
+def writeStatistics(args, statistics):
+    summaries = [statistics[portName].summary() for portName in statistics]
+    if args.stats:
+        with open(args.stats[0], "a") as f:
+            for summary in summaries:
+                f.write(json.dumps(summary) + "\n")
+            if len(summaries) > 1:
+                f.write(json.dumps(aggregateStatistics(summaries)) + "\n")
+    if args.trace:
+        events = []
+        for (pid, portName) in enumerate(statistics):
+            events += statistics[portName].traceEvents(pid + 1)
+        with open(args.trace[0], "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
 def main():
     ser_list = sorted(ports.device for ports in list_ports.comports())
-    defaultPort = str(ser_list[-1:][0])
+    defaultPort = ser_list[-1] if len(ser_list) > 0 else None
     parser = argparse.ArgumentParser(description="BL602 flashing tool")
-    parser.add_argument("-p", "--port", dest="port", nargs=1, default=[defaultPort], help="The serial port to use")
-    parser.add_argument("-b", "--baudrate", dest="baudrate", nargs=1, default=[115200], type=int, help="The speed at which to communicate")
+    parser.add_argument("-p", "--port", dest="port", nargs="+", default=[defaultPort], help="The serial port(s) to use, multiple ports are handled in parallel")
+    parser.add_argument("-u", "--usb", dest="usb", nargs="+", help="Use all serial ports of the USB devices with these VID:PID pairs (hexadecimal)")
+    parser.add_argument("-b", "--baudrate", dest="baudrate", nargs=1, default=[115200], type=int, help="The speed at which to communicate with the bootrom")
+    parser.add_argument("-f", "--flash-baudrate", dest="flashBaudrate", nargs=1, default=["auto"], help="The speed at which to communicate with the eflash loader, auto tries 2000000, 1000000 and 460800 (default: auto)")
+    parser.add_argument("--loader", dest="loader", nargs=1, default=["auto"], choices=["auto"] + list(loaderFiles.keys()), help="The eflash loader to use, auto uses the 40m loader for baudrates above 115200 when the boot header in flash configures a 40 MHz crystal (default: auto)")
+    parser.add_argument("--reload", dest="reload", action="store_true", help="Do not look for an eflash loader that is already running, always upload it")
     parser.add_argument("-i", "--info", dest="info", action="store_true", help="Read OTP information")
-    parser.add_argument("-e", "--erase", dest="erase", action="store_true", help="Erase flash")
-    parser.add_argument("-w", "--write", dest="write", nargs=2, help="Write to flash [address file]")
+    parser.add_argument("-e", "--erase", dest="erase", action="store_true", help="Erase the whole flash chip")
+    parser.add_argument("--no-erase", dest="noErase", action="store_true", help="Do not erase the sectors touched by a write")
+    parser.add_argument("-w", "--write", dest="write", nargs=2, action="append", default=[], help="Write to flash [address file], can be repeated")
+    parser.add_argument("-m", "--manifest", dest="manifest", nargs=1, help="Write all regions listed in this TOML file")
     parser.add_argument("-r", "--read", dest="read", nargs=3, help="Read from flash [address length file]")
-    parser.add_argument("-v", "--verify", dest="verify", action="store_true", help="Verify after writing")
+    parser.add_argument("-n", "--read-partition", dest="readPartitions", nargs="+", help="Read these partitions from the device into separate files, use name:0 or name:1 for a specific slot")
+    parser.add_argument("--partition-directory", dest="partitionDirectory", nargs=1, default=["."], help="Directory to store the partitions read with -n in (default: current directory)")
+    parser.add_argument("--trim", dest="trim", action="store_true", help="Remove the blank (0xFF) bytes at the end of files that are read")
+    parser.add_argument("-v", "--verify", dest="verify", action="store_true", help="Verify after writing by comparing hashes")
+    parser.add_argument("-o", "--ota", dest="ota", nargs=1, help="Write the firmware to the inactive FW slot of the partition table on the device and switch to it")
+    parser.add_argument("-s", "--sparse", dest="sparse", nargs=1, help="Write the data extents listed in this sparse image description of generateImage.py")
+    parser.add_argument("--verify-only", dest="verifyOnly", action="store_true", help="Only compare the files with the flash contents, do not erase or write")
+    parser.add_argument("--match-flash", dest="matchFlash", action="store_true", help="Put the flash configuration of the flash chip on the device in the boot header written to address 0")
+    parser.add_argument("-d", "--differential", dest="differential", action="store_true", help="Only erase and write the sectors that differ from the file")
+    parser.add_argument("-j", "--journal", dest="journal", nargs=1, help="Keep track of written chunks in this directory, running the same write again resumes it")
+    parser.add_argument("--write-blank", dest="writeBlank", action="store_true", help="Also send chunks that only contain 0xFF when writing")
+    parser.add_argument("-P", "--pipeline", dest="pipeline", nargs=1, default=[1], type=int, help="Amount of program commands to keep in flight while writing (default: 1)")
+    parser.add_argument("--stats", dest="stats", nargs=1, help="Append per-command statistics of every device to this file as JSON lines")
+    parser.add_argument("--trace", dest="trace", nargs=1, help="Write a timeline of all commands to this file in Chrome trace format")
+    parser.add_argument("--stats-summary", dest="statsSummary", nargs="+", help="Combine the statistics in these files into one summary and exit")
     parser.add_argument("-L", "--logging", dest="logging", action="store_true", help="Enable communication debug logging")
     args = parser.parse_args()
+
+    if args.statsSummary:
+        summaries = []
+        for filename in args.statsSummary:
+            with open(filename, "r") as f:
+                summaries += [json.loads(line) for line in f if len(line.strip()) > 0 and json.loads(line).get("name") != None]
+        print(json.dumps(aggregateStatistics(summaries), indent=4))
+        return
         
-    port = openPort(args.port[0], args.baudrate[0])
-    brom = BootromCommunication(port, args.logging)
-    brom.sync()
+    # All files are written in one session, sorted by address and with adjacent files combined
+    writes = [(int(address), filename) for (address, filename) in args.write]
+    if args.manifest:
+        writes += loadManifest(args.manifest[0])
+    regions = [(address, mapFile(filename), filename) for (address, filename) in writes]
+    if args.sparse:
+        regions += loadSparse(args.sparse[0])
+    args.regions = planRegions(regions)
+
+    portNames = args.port
+    if args.usb:
+        portNames = findPorts(args.usb)
+    if len(portNames) < 1 or portNames[0] == None:
+        print("No serial port found")
+        exit(1)
     
-    if args.info:
-        result = brom.getBootInfo()
-        print("BootROM version: {:d}".format(result[0]))
-        print("OTP flags:")
-        for y in range(4):
-            for x in range(4):
-                print("{:08b} ".format(result[1][x+y*4]), end="")
-            print("")
+    statistics = {}
+    for portName in portNames:
+        statistics[portName] = Statistics(portName, args.trace != None)
+
+    if len(portNames) == 1:
+        try:
+            passed = flashDevice(portNames[0], args, Reporter(), statistics[portNames[0]])
+        finally:
+            writeStatistics(args, statistics)
+        if not passed:
+            exit(1)
+        return
     
-    if args.erase or args.write or args.read:
-        with open("eflash_loader_rc32m.bin", "rb") as loaderFile:
-            loaderBinary = loaderFile.read()
-        brom.loadAndRunPreprocessedImage(loaderBinary)
-        eflash = EflashLoaderCommunication(port, args.logging)
-        eflash.sync()
-        
-        if args.erase:
-            print("Erasing flash...")
-            eflash.eraseFlash()
-        
-        if args.write:
-            address = int(args.write[0])
-            filename = args.write[1]
-            print("Writing file {} to address 0x{:08x}...".format(filename, address))
-            with open(filename, "rb") as f:
-                data = f.read()
-            eflash.writeFlash(data, address)
-            if args.verify:
-                print("Verifying...")
-                verifyData = eflash.readFlash(address, len(data))
-                if len(verifyData) != len(data):
-                    print("Verification failed, length mismatch!", len(verifyData), len(data))
-                else:
-                    failed = False
-                    for i in range(len(data)):
-                        if (data[i] != verifyData[i]):
-                            print("Verification failed, mismatch at address {:04x}: {:02x} != {:02x}".format(i, data[i], verifyData[i]))
-                            failed = True
-                            break
-                    if not failed:
-                        print("Verified!")
-            
-        if args.read:
-            address = int(args.read[0])
-            length = int(args.read[1])
-            filename = args.read[2]
-            print("Reading {:d} bytes from address 0x{:08x} to file {}...".format(length, address, filename))
-            data = eflash.readFlash(address, length)
-            with open(filename, "wb") as f:
-                f.write(data)
+    results = flashDevices(portNames, args, statistics)
+    writeStatistics(args, statistics)
+    print("")
+    print("Summary")
+    print("----------------------------------------------------------------------------------------------------------")
+    for (portName, passed, error, duration) in results:
+        if error != None:
+            print("{}\tFAIL\t{:.1f}s\t{}".format(portName, duration, error))
+        elif not passed:
+            print("{}\tFAIL\t{:.1f}s\tverification failed".format(portName, duration))
+        else:
+            print("{}\tPASS\t{:.1f}s".format(portName, duration))
+    print("{:d} of {:d} devices passed".format(len([result for result in results if result[1]]), len(results)))
+    if not all([result[1] for result in results]):
+        exit(1)
 
 if __name__ == "__main__":
     main()
@@ -8,7 +8,7 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-import sys, struct, binascii, hashlib
+import headerSchema
 
 class FlashConfig:
     def __init__(self):
@@ -164,12 +164,52 @@ class FlashConfig:
             "qeData": 0x00
         }
 
+        # Differences with appFlashConfig per manufacturer, all of them run in quad IO mode with continuous read
+        # Erase and program times are the worst case values from the datasheets (ms)
+        self.vendorFlashConfigs = {
+            # Winbond, as used by the official flashing tool
+            0xef: {},
+            # GigaDevice, XMC and BoyaMicro: the quad enable bit is written together with status register 1
+            0xc8: {"mid": 0xc8, "writeRegCmd": 0x00000101, "qeWriteRegLen": 0x02, "timeEsector": 0x012c, "timeE32k": 0x0320, "timeE64k": 0x04b0, "timePagePgm": 0x0003, "timeCe": 0x4e20},
+            0x20: {"mid": 0x20, "writeRegCmd": 0x00000101, "qeWriteRegLen": 0x02, "timeEsector": 0x0190, "timeE32k": 0x0640, "timeE64k": 0x07d0, "timePagePgm": 0x0003, "timeCe": 0x61a8},
+            0x68: {"mid": 0x68, "writeRegCmd": 0x00000101, "qeWriteRegLen": 0x02, "timeEsector": 0x012c, "timeE32k": 0x03e8, "timeE64k": 0x04b0, "timePagePgm": 0x0003, "timeCe": 0x4e20}
+        }
+
+        # Known chips by JEDEC ID: manufacturer, memory type and capacity
+        self.flashChips = {
+            0xef4014: "W25Q80",
+            0xef4015: "W25Q16",
+            0xef4016: "W25Q32",
+            0xef4017: "W25Q64",
+            0xc84014: "GD25Q80",
+            0xc84015: "GD25Q16",
+            0xc84016: "GD25Q32",
+            0x204015: "XM25QH16",
+            0x204016: "XM25QH32",
+            0x684015: "BY25Q16",
+            0x684016: "BY25Q32"
+        }
+
+    def forJedecId(self, jedecId):
+        if not jedecId in self.flashChips:
+            raise Exception("Unknown flash chip", "0x{:06x}".format(jedecId))
+        return dict(self.appFlashConfig, **self.vendorFlashConfigs[jedecId >> 16])
+
+    def findChip(self, name):
+        # Returns the JEDEC ID of a chip given by name or as hexadecimal JEDEC ID
+        for (jedecId, chipName) in self.flashChips.items():
+            if chipName.lower() == name.lower():
+                return jedecId
+        try:
+            jedecId = int(name, 16)
+        except ValueError:
+            raise Exception("Unknown flash chip", name)
+        if not jedecId in self.flashChips:
+            raise Exception("Unknown flash chip", name)
+        return jedecId
+
     def generate(self, flash):
-        print("IO", flash["ioMode"])
-        data = struct.pack("<4sBBBBBBBBBBBBBBHBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBLLBBBBBBBBBBBBHHHHHBB", self.magic, flash["ioMode"], flash["cReadSupport"], flash["clkDelay"], flash["clkInvert"], flash["resetEnCmd"], flash["resetCmd"], flash["resetCreadCmd"], flash["resetCreadCmdSize"], flash["jedecIdCmd"], flash["jedecIdCmdDmyClk"], flash["qpiJedecIdCmd"], flash["qpiJedecIdCmdDmyClk"], flash["sectorSize"], flash["mid"], flash["pageSize"], flash["chipEraseCmd"], flash["sectorEraseCmd"], flash["blk32EraseCmd"], flash["blk64EraseCmd"], flash["writeEnableCmd"], flash["pageProgramCmd"], flash["qpageProgramCmd"], flash["qppAddrMode"], flash["fastReadCmd"], flash["frDmyClk"], flash["qpiFastReadCmd"], flash["qpiFrDmyClk"], flash["fastReadDoCmd"], flash["frDoDmyClk"], flash["fastReadDioCmd"], flash["frDioDmyClk"], flash["fastReadQoCmd"], flash["frQoDmyClk"], flash["fastReadQioCmd"], flash["frQioDmyClk"], flash["qpiFastReadQioCmd"], flash["qpiFrQioDmyClk"], flash["qpiPageProgramCmd"], flash["writeVregEnableCmd"], flash["wrEnableIndex"], flash["qeIndex"], flash["busyIndex"], flash["wrEnableBit"], flash["qeBit"], flash["busyBit"], flash["wrEnableWriteRegLen"], flash["wrEnableReadRegLen"], flash["qeWriteRegLen"], flash["qeReadRegLen"], flash["releasePowerDown"], flash["busyReadRegLen"], flash["readRegCmd"], flash["writeRegCmd"], flash["enterQpi"], flash["exitQpi"], flash["cReadMode"], flash["cRExit"], flash["burstWrapCmd"], flash["burstWrapCmdDmyClk"], flash["burstWrapDataMode"], flash["burstWrapData"], flash["deBurstWrapCmd"], flash["deBurstWrapCmdDmyClk"], flash["deBurstWrapDataMode"], flash["deBurstWrapData"], flash["timeEsector"], flash["timeE32k"], flash["timeE64k"], flash["timePagePgm"], flash["timeCe"], flash["pdDelay"], flash["qeData"])
-        crc32 = binascii.crc32(data[4:], 0)
-        data = data + struct.pack("<L", crc32)
-        return data
+        return headerSchema.flashConfig.encode(flash)
 
 class ClockConfig:
     def __init__(self):
@@ -184,31 +224,97 @@ class ClockConfig:
             "26M": 5,
             "RC32M": 6
         }
+        # System clock select (GLB_SYS_CLK_Type of the SDK): the internal RC oscillator, the crystal or a PLL output
         self.pllClkTypes = {
-            "480M": 0,
-            "240M": 1,
-            "192M": 2,
-            "160M": 3,
-            "120M": 4,
-            "96M": 5,
-            "80M": 6,
-            "48M": 7,
-            "32M": 8
+            "RC32M": 0,
+            "XTAL": 1,
+            "48M": 2,
+            "120M": 3,
+            "160M": 4,
+            "192M": 5
         }
         self.defaultClockConfig = {
             "xtalType": self.xtalTypes["40M"],
-            "pllClk": self.pllClkTypes["120M"],
+            "pllClk": self.pllClkTypes["160M"],
             "hclkDiv": 0x00,
             "bclkDiv": 0x01,
             "flashClkType": 0x03,
             "flashClkDiv": 0x01
         }
+        # Sources of the flash clock, XCLK is the crystal or the internal RC oscillator
+        self.flashClkTypes = {
+            "120M": 0,
+            "XCLK": 1,
+            "48M": 2,
+            "80M": 3,
+            "BCLK": 4,
+            "96M": 5
+        }
+
+        # The CPU runs at pllClk / (hclkDiv + 1), the bus at that / (bclkDiv + 1) and the flash at its source / (flashClkDiv + 1)
+        self.clockProfiles = {
+            # 160 MHz CPU, 80 MHz bus, 40 MHz flash
+            "default": self.defaultClockConfig,
+            # 160 MHz CPU, 80 MHz bus, 48 MHz flash
+            "performance": dict(self.defaultClockConfig, pllClk=self.pllClkTypes["160M"], bclkDiv=0x01, flashClkType=self.flashClkTypes["96M"], flashClkDiv=0x01),
+            # 192 MHz CPU, 64 MHz bus, 80 MHz flash, needs a flash configuration with a clock delay
+            "max-performance": dict(self.defaultClockConfig, pllClk=self.pllClkTypes["192M"], bclkDiv=0x02, flashClkType=self.flashClkTypes["80M"], flashClkDiv=0x00),
+            # 48 MHz CPU and bus, flash on the crystal
+            "low-power": dict(self.defaultClockConfig, pllClk=self.pllClkTypes["48M"], bclkDiv=0x00, flashClkType=self.flashClkTypes["XCLK"], flashClkDiv=0x00),
+            # Boards without a crystal run everything from the internal RC oscillator
+            "rc32m": dict(self.defaultClockConfig, xtalType=self.xtalTypes["RC32M"], pllClk=self.pllClkTypes["RC32M"], bclkDiv=0x00, flashClkType=self.flashClkTypes["XCLK"], flashClkDiv=0x00)
+        }
+
+        # Limits of the chip (MHz)
+        self.maxHclk = 192
+        self.maxBclk = 80
+        self.maxFlashClk = 80
+        # Flash clocks above this need the flash configuration to delay sampling the data
+        self.maxFlashClkWithoutDelay = 50
+
+    def frequencies(self, config):
+        # Returns the CPU, bus and flash clock frequencies (MHz) of a clock configuration
+        xtalNames = {value: name for (name, value) in self.xtalTypes.items()}
+        pllNames = {value: name for (name, value) in self.pllClkTypes.items()}
+        flashNames = {value: name for (name, value) in self.flashClkTypes.items()}
+        if not config["xtalType"] in xtalNames:
+            raise Exception("Invalid clock configuration, unknown crystal type", config["xtalType"])
+        if not config["pllClk"] in pllNames:
+            raise Exception("Invalid clock configuration, unknown system clock", config["pllClk"])
+        if not config["flashClkType"] in flashNames:
+            raise Exception("Invalid clock configuration, unknown flash clock source", config["flashClkType"])
+        xclk = 32.0 if xtalNames[config["xtalType"]] in ["none", "RC32M"] else float(xtalNames[config["xtalType"]].replace("P", ".")[:-1])
+        systemClk = {"RC32M": 32.0, "XTAL": xclk}.get(pllNames[config["pllClk"]]) or float(pllNames[config["pllClk"]][:-1])
+        hclk = systemClk / (config["hclkDiv"] + 1)
+        bclk = hclk / (config["bclkDiv"] + 1)
+        flashSource = flashNames[config["flashClkType"]]
+        sourceClk = {"XCLK": xclk, "BCLK": bclk}[flashSource] if flashSource in ["XCLK", "BCLK"] else float(flashSource[:-1])
+        flashClk = sourceClk / (config["flashClkDiv"] + 1)
+        return {"xclk": xclk, "hclk": hclk, "bclk": bclk, "flash": flashClk}
+
+    def validate(self, config, flash = None):
+        # Raises an exception for clock configurations the bootrom can not run, flash is the flash configuration that goes with it
+        clocks = self.frequencies(config)
+        pllNames = {value: name for (name, value) in self.pllClkTypes.items()}
+        flashNames = {value: name for (name, value) in self.flashClkTypes.items()}
+        if config["xtalType"] in [self.xtalTypes["none"], self.xtalTypes["RC32M"]]:
+            # Without a crystal the PLL does not run, only the RC oscillator can be the system clock
+            if pllNames[config["pllClk"]] != "RC32M":
+                raise Exception("Invalid clock configuration, the system clock needs a crystal", pllNames[config["pllClk"]])
+            if not flashNames[config["flashClkType"]] in ["XCLK", "BCLK"]:
+                raise Exception("Invalid clock configuration, the flash clock source needs a crystal", flashNames[config["flashClkType"]])
+        if clocks["hclk"] > self.maxHclk:
+            raise Exception("Invalid clock configuration, CPU clock too high (MHz)", clocks["hclk"], self.maxHclk)
+        if clocks["bclk"] > self.maxBclk:
+            raise Exception("Invalid clock configuration, bus clock too high (MHz)", clocks["bclk"], self.maxBclk)
+        if clocks["flash"] > self.maxFlashClk:
+            raise Exception("Invalid clock configuration, flash clock too high (MHz)", clocks["flash"], self.maxFlashClk)
+        if flash != None and clocks["flash"] > self.maxFlashClkWithoutDelay and flash["clkDelay"] == 0:
+            raise Exception("Invalid clock configuration, the flash configuration has no clock delay for this flash clock (MHz)", clocks["flash"])
+        return clocks
 
     def generate(self, config):
-        data = struct.pack("<4sBBBBBBH", self.magic, config["xtalType"], config["pllClk"], config["hclkDiv"], config["bclkDiv"], config["flashClkType"], config["flashClkDiv"], 0)
-        crc32 = binascii.crc32(data[4:], 0)
-        data = data + struct.pack("<L", crc32)
-        return data
+        return headerSchema.clockConfig.encode(config)
 
 class BootConfig:
     def __init__(self):
@@ -223,7 +329,7 @@ class BootConfig:
         self.flashConfig = FlashConfig()
         self.clockConfig = ClockConfig()
     
-    def generate(self, config = None, flash = None, clock = None, sha256hash = bytes([0]*32)):
+    def record(self, config = None, flash = None, clock = None, sha256hash = bytes([0]*32)):
         if not config:
             config = self.defaultBootConfig
         if not flash:
@@ -231,10 +337,17 @@ class BootConfig:
             flash = self.flashConfig.defaultFlashConfig
         if not clock:
             clock = self.clockConfig.defaultClockConfig
-        data = struct.pack("<4sL92s16sLLLL32sLL", self.magic, self.revision, self.flashConfig.generate(flash), self.clockConfig.generate(clock), config["bootCfg"], config["imgSegmentInfo"], config["bootEntry"], config["imgStart"], sha256hash, 0, 0)
-        crc32 = binascii.crc32(data[0:], 0)
-        data = data + struct.pack("<L", crc32)
-        return data
+        values = dict(config, revision=self.revision, sha256hash=sha256hash)
+        values["flashConfig"] = headerSchema.flashConfig.create(flash)
+        values["clockConfig"] = headerSchema.clockConfig.create(clock)
+        return headerSchema.bootHeader.create(values)
+
+    def generate(self, config = None, flash = None, clock = None, sha256hash = bytes([0]*32)):
+        return headerSchema.bootHeader.encode(self.record(config, flash, clock, sha256hash))
+
+    def generateMany(self, headers):
+        # Generates the boot headers of many images at once, headers is a list of (config, flash, clock, sha256hash) tuples
+        return headerSchema.bootHeader.encodeMany([self.record(*header) for header in headers])
 
 def main():
     config = BootConfig()
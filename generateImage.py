@@ -8,67 +8,286 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-import sys, struct, binascii, hashlib, generateHeaders
+import os, json, lzma, binascii, hashlib, argparse, generateHeaders, headerSchema
+import partitionBinToToml, partitionTomlToBin
+
+# Flash addresses of the parts of the image, can be changed with a TOML layout file
+defaultLayout = {
+    "bootHeader": 0x0000,
+    "bootloader": 0x2000,
+    "partitions": [0xE000, 0xF000],
+    "appHeader": 0x10000,
+    "app": 0x11000
+}
+
+blockSize = 65536
+
+# The xz decoder of boot2 only handles LZMA2 with a small dictionary and CRC32 checks
+xzFilters = [{"id": lzma.FILTER_LZMA2, "preset": 9, "dict_size": 32768}]
 
 def calcHash(data):
     s = hashlib.sha256()
     s.update(data)
     return s.digest()
 
+def readBlocks(filename, filler = bytes([])):
+    # Yields the file in blocks followed by the filler, files are never read into memory as a whole
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(blockSize)
+            if len(block) < 1:
+                break
+            yield block
+    if len(filler) > 0:
+        yield filler
+
+def calcFileHash(filename, filler = bytes([])):
+    s = hashlib.sha256()
+    for block in readBlocks(filename, filler):
+        s.update(block)
+    return s.digest()
+
+def compressFirmware(data):
+    return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, filters=xzFilters)
+
+def setFirmwareLength(partitions, length):
+    # Returns the partition table with the len of the FW partition set, boot2 needs it to unpack compressed firmware
+    (header, entries) = partitionBinToToml.parsePartitionTable(partitions)
+    firmware = [entry for entry in entries if entry["type"] == 0]
+    if len(firmware) != 1:
+        raise Exception("The partition table does not contain a FW partition")
+    if length > firmware[0]["size0"]:
+        raise Exception("The firmware does not fit in the FW partition", length, firmware[0]["size0"])
+    firmware[0]["len"] = length
+    return partitionTomlToBin.packPartitionTable(entries, header["version"], header["age"])
+
+class BuildCache:
+    # Stores file digests and generated headers in a directory, keyed by a hash of everything they depend on.
+    # Entries that have not been used for the longest time are removed when the cache grows over maxSize bytes.
+    def __init__(self, directory, maxSize = 64*1024*1024):
+        self.directory = directory
+        self.maxSize = maxSize
+        os.makedirs(directory, exist_ok=True)
+        # Headers are generated again when the generator changes
+        self.generator = (calcFileHash(generateHeaders.__file__) + calcFileHash(headerSchema.__file__)).hex()
+
+    def key(self, kind, **inputs):
+        inputs["kind"] = kind
+        inputs["generator"] = self.generator
+        description = json.dumps(inputs, sort_keys=True, default=lambda value: binascii.hexlify(value).decode("ascii"))
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        filename = os.path.join(self.directory, key)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(filename)
+        return data
+
+    def put(self, key, data):
+        filename = os.path.join(self.directory, key)
+        with open(filename + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(filename + ".tmp", filename)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            status = os.stat(os.path.join(self.directory, name))
+            entries.append((status.st_mtime, status.st_size, name))
+        total = sum([entry[1] for entry in entries])
+        for (used, size, name) in sorted(entries):
+            if total <= self.maxSize:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def fileHash(self, filename, filler = bytes([])):
+        # Files are identified by path, size and modification time, so unchanged inputs are not read at all
+        status = os.stat(filename)
+        key = self.key("hash", path=os.path.abspath(filename), size=status.st_size, modified=status.st_mtime_ns, filler=filler)
+        digest = self.get(key)
+        if digest == None:
+            digest = calcFileHash(filename, filler)
+            self.put(key, digest)
+        return digest
+
+    def bootHeader(self, generator, config, flash, clock, sha256hash):
+        key = self.key("header", config=config, flash=flash, clock=clock, sha256hash=sha256hash)
+        header = self.get(key)
+        if header == None:
+            header = generator.generate(config = config, flash = flash, clock = clock, sha256hash = sha256hash)
+            self.put(key, header)
+        return header
+
+    def compress(self, data):
+        key = self.key("xz", sha256=calcHash(data), filters=repr(xzFilters))
+        compressed = self.get(key)
+        if compressed == None:
+            compressed = compressFirmware(data)
+            self.put(key, compressed)
+        return compressed
+
+class NoCache:
+    def fileHash(self, filename, filler = bytes([])):
+        return calcFileHash(filename, filler)
+
+    def compress(self, data):
+        return compressFirmware(data)
+
+    def bootHeader(self, generator, config, flash, clock, sha256hash):
+        return generator.generate(config = config, flash = flash, clock = clock, sha256hash = sha256hash)
+
+def loadLayout(filename):
+    import toml
+    layout = dict(defaultLayout)
+    with open(filename, "r") as f:
+        data = toml.load(f)
+    for key in data:
+        if not key in layout:
+            print("Error: found unknown layout parameter {}!".format(key))
+            exit(1)
+        layout[key] = data[key]
+    return layout
+
+class ImageWriter:
+    # Streams segments to the image in address order, fills the gaps with 0xFF and remembers where the data is
+    def __init__(self, f):
+        self.f = f
+        self.position = 0
+        self.extents = []
+
+    def pad(self, address):
+        if address < self.position:
+            raise Exception("Segments overlap", hex(address), hex(self.position))
+        while self.position < address:
+            amount = min(blockSize, address - self.position)
+            self.f.write(bytes([0xFF]) * amount)
+            self.position += amount
+
+    def write(self, address, blocks, digest = None):
+        # The digest is calculated while writing unless it is already known
+        self.pad(address)
+        s = hashlib.sha256()
+        length = 0
+        for block in blocks:
+            self.f.write(block)
+            if digest == None:
+                s.update(block)
+            length += len(block)
+        self.position += length
+        if length > 0:
+            self.extents.append({"address": address, "length": length, "sha256": (digest or s.digest()).hex()})
+
 def main():
+    parser = argparse.ArgumentParser(description="Generate a BL602 flash image from an application")
+    parser.add_argument("app", help="The application binary")
+    parser.add_argument("image", help="The flash image to write")
+    parser.add_argument("-b", "--bootloader", dest="bootloader", default="blsp_boot2.bin", help="The bootloader binary (default: blsp_boot2.bin)")
+    parser.add_argument("-p", "--partitions", dest="partitions", default="partitions.bin", help="The partition table binary (default: partitions.bin)")
+    parser.add_argument("-l", "--layout", dest="layout", help="TOML file with the flash addresses of the parts of the image")
+    parser.add_argument("-c", "--cache", dest="cache", help="Directory to keep file hashes and boot headers in, so unchanged parts are not processed again")
+    parser.add_argument("--cache-size", dest="cacheSize", default=64, type=int, help="Maximum size of the cache in megabytes (default: 64)")
+    parser.add_argument("-F", "--flash", dest="flash", help="Flash chip on the board, by name (W25Q16) or JEDEC ID (ef4015), selects the flash configuration in the boot headers")
+    parser.add_argument("-C", "--clock", dest="clock", default="default", choices=list(generateHeaders.ClockConfig().clockProfiles.keys()), help="Clock profile to boot with (default: default)")
+    parser.add_argument("--xtal", dest="xtal", choices=list(generateHeaders.ClockConfig().xtalTypes.keys()), help="Crystal on the board, overrides the one of the clock profile")
+    parser.add_argument("-z", "--compress", dest="compress", action="store_true", help="Compress the FW partition (application header and application) with xz and set its len in the partition table")
+    parser.add_argument("-f", "--firmware", dest="firmware", help="Also write the contents of the FW partition to this file, for bltool.py -o")
+    parser.add_argument("-s", "--sparse", dest="sparse", help="Also write a JSON file listing the parts of the image that contain data, with their SHA-256 hashes")
+    args = parser.parse_args()
+
+    layout = defaultLayout
+    if args.layout:
+        layout = loadLayout(args.layout)
+
+    cache = NoCache()
+    if args.cache:
+        cache = BuildCache(args.cache, args.cacheSize * 1024 * 1024)
+
     bootHeaderGenerator = generateHeaders.BootConfig()
-    sectorSize = 4096 # bytes
-    emptySector = bytes([0xFF] * sectorSize)
-    
-    if len(sys.argv) != 3:
-        print("Usage: {} <app> <flash image>")
-        exit(1)
-    
-    with open("blsp_boot2.bin", "rb") as f:
-        bootloader = f.read()
-    bootloaderAndFiller = bootloader + bytes([0]*12)
-    bootloaderHash = calcHash(bootloaderAndFiller)
-    
-    with open("partitions.bin", "rb") as f:
+    flashConfig = bootHeaderGenerator.flashConfig.appFlashConfig
+    if args.flash:
+        jedecId = bootHeaderGenerator.flashConfig.findChip(args.flash)
+        flashConfig = bootHeaderGenerator.flashConfig.forJedecId(jedecId)
+        print("Flash: {} (0x{:06x})".format(bootHeaderGenerator.flashConfig.flashChips[jedecId], jedecId))
+    clockConfig = bootHeaderGenerator.clockConfig.clockProfiles[args.clock]
+    if args.xtal:
+        clockConfig = dict(clockConfig, xtalType=bootHeaderGenerator.clockConfig.xtalTypes[args.xtal])
+    clocks = bootHeaderGenerator.clockConfig.validate(clockConfig, flashConfig)
+    print("Clock: {}, CPU {:g} MHz, bus {:g} MHz, flash {:g} MHz".format(args.clock, clocks["hclk"], clocks["bclk"], clocks["flash"]))
+    bootloaderFiller = bytes([0]*12)
+    bootloaderLength = os.path.getsize(args.bootloader) + len(bootloaderFiller)
+    appFiller = bytes([0]*4)
+    appLength = os.path.getsize(args.app) + len(appFiller)
+
+    with open(args.partitions, "rb") as f:
         partitions = f.read()
-    
-    # User application
-    with open(sys.argv[1], "rb") as f:
-        app = f.read()
-    appAndFiller = app + bytes([0]*4)
-    appHash = calcHash(appAndFiller)
-    
-    appBootConfig = {
+
+    print("Length BL: {:02x} / {:02x}".format(bootloaderLength - len(bootloaderFiller), bootloaderLength))
+    print("Length AP: {:02x} / {:02x}".format(appLength - len(appFiller), appLength))
+
+    bootConfig = {
         "bootCfg": 0x3300,
-        "imgSegmentInfo": len(appAndFiller),
+        "imgSegmentInfo": bootloaderLength,
         "bootEntry": 0x0000,
         "imgStart": 0x2000
     }
-    
-    print("Length BL: {:02x} / {:02x}".format(len(bootloader), len(bootloaderAndFiller)))
-    print("Length AP: {:02x} / {:02x}".format(len(app), len(appAndFiller)))
-    
-    appBootHeader = bootHeaderGenerator.generate(config = appBootConfig, flash = bootHeaderGenerator.flashConfig.appFlashConfig, sha256hash = appHash)
-    
-    imageData  = emptySector
-    imageData += bootloaderAndFiller + bytes([0xFF] * (sectorSize - ((len(bootloaderAndFiller)) % 4096)))
-    imageData += (emptySector * 2)
-    imageData += partitions
-    imageData += partitions
-    imageData += appBootHeader + bytes([0xFF] * (sectorSize - len(appBootHeader)))
-    imageData += appAndFiller + bytes([0xFF] * (sectorSize - ((len(appAndFiller)) % 4096)))
-    
-    bootConfig = {
+    bootloaderHash = cache.fileHash(args.bootloader, bootloaderFiller)
+    bootHeader = cache.bootHeader(bootHeaderGenerator, bootConfig, flashConfig, clockConfig, bootloaderHash)
+
+    appBootConfig = {
         "bootCfg": 0x3300,
-        "imgSegmentInfo": len(bootloaderAndFiller),
+        "imgSegmentInfo": appLength,
         "bootEntry": 0x0000,
         "imgStart": 0x2000
     }
-    bootHeader = bootHeaderGenerator.generate(config = bootConfig, flash = bootHeaderGenerator.flashConfig.appFlashConfig, sha256hash = bootloaderHash)
-    image = bootHeader + bytes([0xFF] * (sectorSize - len(bootHeader))) + imageData
-    
-    with open(sys.argv[2], "wb") as f:
-        f.write(image)
+    appHash = cache.fileHash(args.app, appFiller)
+    appBootHeader = cache.bootHeader(bootHeaderGenerator, appBootConfig, flashConfig, clockConfig, appHash)
+
+    segments = [
+        (layout["bootHeader"], [bootHeader], None),
+        (layout["bootloader"], readBlocks(args.bootloader, bootloaderFiller), bootloaderHash)
+    ]
+    if args.compress or args.firmware:
+        # The FW partition holds the application header followed by the application at its own address
+        firmware = bytearray(appBootHeader)
+        firmware += bytes([0xFF]) * (layout["app"] - layout["appHeader"] - len(appBootHeader))
+        for block in readBlocks(args.app, appFiller):
+            firmware += block
+        if args.compress:
+            firmware = cache.compress(firmware)
+            print("Compressed FW: {:d} / {:d} bytes ({:.1f}%)".format(len(firmware), layout["app"] - layout["appHeader"] + appLength, 100.0 * len(firmware) / (layout["app"] - layout["appHeader"] + appLength)))
+            partitions = setFirmwareLength(partitions, len(firmware))
+            segments.append((layout["appHeader"], [firmware], None))
+        if args.firmware:
+            with open(args.firmware, "wb") as f:
+                f.write(firmware)
+    if not args.compress:
+        segments.append((layout["appHeader"], [appBootHeader], None))
+        segments.append((layout["app"], readBlocks(args.app, appFiller), appHash))
+    for address in layout["partitions"]:
+        segments.append((address, [partitions], None))
+
+    with open(args.image, "wb") as f:
+        image = ImageWriter(f)
+        for (address, blocks, digest) in sorted(segments, key=lambda segment: segment[0]):
+            image.write(address, blocks, digest)
+        # The last sector is filled up, like all others
+        image.pad((image.position + 4095) // 4096 * 4096)
+
+    if args.sparse:
+        sparse = {
+            "image": os.path.relpath(args.image, os.path.dirname(os.path.abspath(args.sparse))),
+            "size": image.position,
+            "extents": image.extents
+        }
+        with open(args.sparse, "w") as f:
+            json.dump(sparse, f, indent=4)
+        print("Data: {:d} of {:d} bytes in {:d} extents".format(sum([extent["length"] for extent in image.extents]), image.position, len(image.extents)))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,166 @@
+"""
+Copyright 2020 Renze Nicolai
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import struct, binascii
+
+# The layout of the boot header and the flash and clock configuration in it, used for generating as well as parsing them
+
+class Record:
+    # Base of the record classes the schemas create, every field is a slot
+    __slots__ = ()
+    schema = None
+
+    def __init__(self, *args, **kwargs):
+        for (name, value) in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for (name, value) in kwargs.items():
+            setattr(self, name, value)
+
+    def asDict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def replace(self, **kwargs):
+        values = self.asDict()
+        values.update(kwargs)
+        return type(self)(**values)
+
+    def encode(self):
+        return self.schema.encode(self)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.asDict() == other.asDict()
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(["{}={!r}".format(name, value) for (name, value) in self.asDict().items()]))
+
+class Schema:
+    def __init__(self, name, magic, fields, tag, crcStart = 4):
+        # Fields are (name, struct format) tuples in the order they are stored, a nested schema can be used as format
+        # The first field is the magic and the last one the CRC32 over data[crcStart:-4]
+        self.name = name
+        self.magic = magic
+        self.fields = fields
+        self.tag = tag
+        self.crcStart = crcStart
+        self.names = [name for (name, fmt) in fields]
+        self.nested = {name: fmt for (name, fmt) in fields if isinstance(fmt, Schema)}
+        self.struct = struct.Struct("<" + "".join([("{:d}s".format(fmt.struct.size) if isinstance(fmt, Schema) else fmt) for (name, fmt) in fields]))
+        self.size = self.struct.size
+        self.record = type(name, (Record,), {"__slots__": tuple(self.names), "schema": self})
+        self.defaults = {"magic": magic, "crc32": 0}
+        for (name, fmt) in fields:
+            if name.startswith("rsvd"):
+                self.defaults[name] = 0
+
+    def create(self, values):
+        # Returns a record from a dict, the magic, CRC and reserved fields may be left out
+        return self.record(**dict(self.defaults, **values))
+
+    def values(self, record):
+        # Returns the values to pack, nested records and dicts are encoded, magic, CRC and reserved fields may be left out
+        if isinstance(record, Record):
+            record = record.asDict()
+        values = []
+        for name in self.names:
+            if name in record:
+                value = record[name]
+            elif name in self.defaults:
+                value = self.defaults[name]
+            else:
+                raise Exception("[{}] field is missing".format(self.tag), name)
+            if name in self.nested and not isinstance(value, (bytes, bytearray)):
+                value = self.nested[name].encode(value)
+            values.append(value)
+        return values
+
+    def encodeInto(self, buffer, offset, record):
+        # Packs the record into the buffer and fills in the magic and the CRC32
+        values = self.values(record)
+        values[0] = self.magic
+        values[-1] = 0
+        self.struct.pack_into(buffer, offset, *values)
+        crc32 = binascii.crc32(memoryview(buffer)[offset+self.crcStart:offset+self.size-4], 0)
+        struct.pack_into("<L", buffer, offset + self.size - 4, crc32)
+
+    def encode(self, record):
+        data = bytearray(self.size)
+        self.encodeInto(data, 0, record)
+        return bytes(data)
+
+    def encodeMany(self, records):
+        # Encodes all records into a single buffer, one after the other
+        data = bytearray(self.size * len(records))
+        for (index, record) in enumerate(records):
+            self.encodeInto(data, index * self.size, record)
+        return bytes(data)
+
+    def check(self, data, values):
+        if values[0] != self.magic:
+            raise Exception("[{}] magic is wrong ({}), expected {}".format(self.tag, values[0], self.magic.decode("ascii")))
+        calcCrc32 = binascii.crc32(data[self.crcStart:-4], 0)
+        if values[-1] != calcCrc32:
+            raise Exception("[{}] crc32 is wrong".format(self.tag), values[-1], calcCrc32)
+
+    def build(self, values, strict):
+        # Nested records that are not valid are kept as bytes when not strict, so encoding them again gives the same data
+        record = self.record(*values)
+        for (name, schema) in self.nested.items():
+            raw = getattr(record, name)
+            try:
+                setattr(record, name, schema.decode(raw, strict))
+            except Exception:
+                if strict:
+                    raise
+        return record
+
+    def decode(self, data, strict = True):
+        # Parses a record and checks the magic and CRC32, nested records are only checked when strict
+        if len(data) != self.size:
+            raise Exception("[{}] data length is wrong: {:d}, expected {:d}".format(self.tag, len(data), self.size))
+        values = self.struct.unpack(data)
+        self.check(data, values)
+        return self.build(values, strict)
+
+    def decodeMany(self, data, strict = True):
+        # Parses a buffer holding records one after the other
+        if len(data) % self.size != 0:
+            raise Exception("[{}] data length is not a multiple of {:d}".format(self.tag, self.size), len(data))
+        view = memoryview(data)
+        records = []
+        for (index, values) in enumerate(self.struct.iter_unpack(view)):
+            self.check(view[index*self.size:(index+1)*self.size], values)
+            records.append(self.build(values, strict))
+        return records
+
+flashConfig = Schema("FlashConfig", b"FCFG", [
+    ("magic", "4s"), ("ioMode", "B"), ("cReadSupport", "B"), ("clkDelay", "B"), ("clkInvert", "B"), ("resetEnCmd", "B"), ("resetCmd", "B"),
+    ("resetCreadCmd", "B"), ("resetCreadCmdSize", "B"), ("jedecIdCmd", "B"), ("jedecIdCmdDmyClk", "B"), ("qpiJedecIdCmd", "B"),
+    ("qpiJedecIdCmdDmyClk", "B"), ("sectorSize", "B"), ("mid", "B"), ("pageSize", "H"), ("chipEraseCmd", "B"), ("sectorEraseCmd", "B"),
+    ("blk32EraseCmd", "B"), ("blk64EraseCmd", "B"), ("writeEnableCmd", "B"), ("pageProgramCmd", "B"), ("qpageProgramCmd", "B"),
+    ("qppAddrMode", "B"), ("fastReadCmd", "B"), ("frDmyClk", "B"), ("qpiFastReadCmd", "B"), ("qpiFrDmyClk", "B"), ("fastReadDoCmd", "B"),
+    ("frDoDmyClk", "B"), ("fastReadDioCmd", "B"), ("frDioDmyClk", "B"), ("fastReadQoCmd", "B"), ("frQoDmyClk", "B"), ("fastReadQioCmd", "B"),
+    ("frQioDmyClk", "B"), ("qpiFastReadQioCmd", "B"), ("qpiFrQioDmyClk", "B"), ("qpiPageProgramCmd", "B"), ("writeVregEnableCmd", "B"),
+    ("wrEnableIndex", "B"), ("qeIndex", "B"), ("busyIndex", "B"), ("wrEnableBit", "B"), ("qeBit", "B"), ("busyBit", "B"),
+    ("wrEnableWriteRegLen", "B"), ("wrEnableReadRegLen", "B"), ("qeWriteRegLen", "B"), ("qeReadRegLen", "B"), ("releasePowerDown", "B"),
+    ("busyReadRegLen", "B"), ("readRegCmd", "L"), ("writeRegCmd", "L"), ("enterQpi", "B"), ("exitQpi", "B"), ("cReadMode", "B"),
+    ("cRExit", "B"), ("burstWrapCmd", "B"), ("burstWrapCmdDmyClk", "B"), ("burstWrapDataMode", "B"), ("burstWrapData", "B"),
+    ("deBurstWrapCmd", "B"), ("deBurstWrapCmdDmyClk", "B"), ("deBurstWrapDataMode", "B"), ("deBurstWrapData", "B"), ("timeEsector", "H"),
+    ("timeE32k", "H"), ("timeE64k", "H"), ("timePagePgm", "H"), ("timeCe", "H"), ("pdDelay", "B"), ("qeData", "B"), ("crc32", "L")
+], "FL")
+
+clockConfig = Schema("ClockConfig", b"PCFG", [
+    ("magic", "4s"), ("xtalType", "B"), ("pllClk", "B"), ("hclkDiv", "B"), ("bclkDiv", "B"), ("flashClkType", "B"), ("flashClkDiv", "B"),
+    ("rsvd", "H"), ("crc32", "L")
+], "CL")
+
+bootHeader = Schema("BootHeader", b"BFNP", [
+    ("magic", "4s"), ("revision", "L"), ("flashConfig", flashConfig), ("clockConfig", clockConfig), ("bootCfg", "L"), ("imgSegmentInfo", "L"),
+    ("bootEntry", "L"), ("imgStart", "L"), ("sha256hash", "32s"), ("rsvd1", "L"), ("rsvd2", "L"), ("crc32", "L")
+], "BH", 0)
@@ -10,38 +10,67 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 
 import sys, struct, binascii, hashlib
 
-def readPartitionEntry(data):
+def parsePartitionEntry(data):
     (partitionType, device, activeIndex, name, address0, address1, maxLen0, maxLen1, length, age) = struct.unpack("<BBB9sLLLLLL", data)
-    print("type = {:d}".format(partitionType))
-    print("name = \"{}\"".format(name.decode("utf-8")))
-    print("device = {:d}".format(device))
-    print("address0 = 0x{:x}".format(address0))
-    print("size0 = 0x{:x}".format(maxLen0))
-    print("address1 = 0x{:x}".format(address1))
-    print("size1 = 0x{:x}".format(maxLen1))
-    print("len = {:d}".format(length))
-    print("#age = {:d}".format(age))
-    print("#activeindex = {:d}".format(activeIndex))
+    return {
+        "type": partitionType,
+        "name": name.rstrip(b"\x00").decode("utf-8"),
+        "device": device,
+        "address0": address0,
+        "size0": maxLen0,
+        "address1": address1,
+        "size1": maxLen1,
+        "len": length,
+        "age": age,
+        "activeIndex": activeIndex
+    }
 
-def readPartitionTable(data):
+def parsePartitionTable(data):
+    # Returns the table header and its entries as dicts, raises an exception when the table is not valid
     if len(data) < 16:
-        print("Input file is too short ({:d} bytes), expected at least 16 bytes".format(len(data)))
-        exit(1)
+        raise Exception("Input file is too short ({:d} bytes), expected at least 16 bytes".format(len(data)))
     (magic, version, entryCnt, age, crc32) = struct.unpack("<4sHHLL", data[:16])
     if magic != b"BFPT":
-        print("The magic value is wrong ({}), expected BFPT".format(magic))
-        exit(1)
+        raise Exception("The magic value is wrong ({}), expected BFPT".format(magic))
     calcCrc32 = binascii.crc32(data[0:12], 0)
     if crc32 != calcCrc32:
-        print("The CRC32 checksum of the partition table header does not match", crc32, calcCrc32)
+        raise Exception("The CRC32 checksum of the partition table header does not match", crc32, calcCrc32)
+    if len(data) < 16 + 36*entryCnt + 4:
+        raise Exception("The partition table is truncated")
+    entries = data[16:16+36*entryCnt]
+    (crc32,) = struct.unpack("<L", data[16+36*entryCnt:16+36*entryCnt+4])
+    calcCrc32 = binascii.crc32(entries, 0)
+    if crc32 != calcCrc32:
+        raise Exception("The CRC32 checksum of the partition table entries does not match", crc32, calcCrc32)
+    header = {"version": version, "age": age}
+    return (header, [parsePartitionEntry(entries[36*i:36*(i+1)]) for i in range(entryCnt)])
+
+def readPartitionEntry(data):
+    entry = parsePartitionEntry(data)
+    print("type = {:d}".format(entry["type"]))
+    print("name = \"{}\"".format(entry["name"]))
+    print("device = {:d}".format(entry["device"]))
+    print("address0 = 0x{:x}".format(entry["address0"]))
+    print("size0 = 0x{:x}".format(entry["size0"]))
+    print("address1 = 0x{:x}".format(entry["address1"]))
+    print("size1 = 0x{:x}".format(entry["size1"]))
+    print("len = {:d}".format(entry["len"]))
+    print("#age = {:d}".format(entry["age"]))
+    print("#activeindex = {:d}".format(entry["activeIndex"]))
+
+def readPartitionTable(data):
+    try:
+        (header, entries) = parsePartitionTable(data)
+    except Exception as e:
+        print(*e.args)
         exit(1)
     print("[pt_table]")
     print("address0 = 0xE000")
     print("address1 = 0xF000")
-    print("#version = {:d}".format(version))
-    print("#age =  {:d}".format(age))
+    print("#version = {:d}".format(header["version"]))
+    print("#age =  {:d}".format(header["age"]))
     print()
-    for i in range(entryCnt):
+    for i in range(len(entries)):
         print("[[pt_entry]]")
         readPartitionEntry(data[16+36*i:16+36*(i+1)])
         print()
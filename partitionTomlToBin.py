@@ -43,14 +43,24 @@ def generatePartitionTableEntry(data):
         elif type(entry[key]) == str:
             entry[key] = data[key].encode("ascii")
     
-    data = struct.pack("<BBB9sLLLLLL", entry["type"], entry["device"], entry["activeIndex"], entry["name"], entry["address0"], entry["address1"], entry["size0"], entry["size1"], entry["len"], entry["age"])
-    return data
+    return packPartitionEntry(entry)
+
+def packPartitionEntry(entry):
+    name = entry["name"]
+    if type(name) == str:
+        name = name.encode("ascii")
+    return struct.pack("<BBB9sLLLLLL", entry["type"], entry["device"], entry["activeIndex"], name, entry["address0"], entry["address1"], entry["size0"], entry["size1"], entry["len"], entry["age"])
 
 def generatePartitionTableHeader(entryCnt, version = 0, age = 0):
     data = b"BFPT" + struct.pack("<HHL", version, entryCnt, age)
     data += struct.pack("<L", binascii.crc32(data, 0))
     return data
 
+def packPartitionTable(entries, version = 0, age = 0):
+    # Builds a table from entries that have already been converted
+    data = bytes([]).join([packPartitionEntry(entry) for entry in entries])
+    return generatePartitionTableHeader(len(entries), version, age) + data + struct.pack("<L", binascii.crc32(data, 0))
+
 def convertPartitionToml(data):
     lines = data.splitlines()
     data = []
@@ -8,163 +8,177 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-import sys, struct, binascii, hashlib
+import sys, os, json, mmap, struct, fnmatch, argparse, binascii, hashlib, collections, concurrent.futures
+import headerSchema
+
+# Whether the image data matches the hash in the header, and which part of the file it covers
+HashStatus = collections.namedtuple("HashStatus", ["match", "offset", "length", "calculated"])
+
+def parseFlashConfig(data):
+    return headerSchema.flashConfig.decode(data)
+
+def parseClockConfig(data):
+    return headerSchema.clockConfig.decode(data)
+
+def parseBootHeader(image):
+    # Returns the boot header with the flash and clock configuration parsed as well, those are None when they are not valid
+    if len(image) < headerSchema.bootHeader.size:
+        raise Exception("[BL] data too short")
+    header = headerSchema.bootHeader.decode(image[:headerSchema.bootHeader.size], strict = False)
+    for name in headerSchema.bootHeader.nested:
+        if not isinstance(getattr(header, name), headerSchema.Record):
+            setattr(header, name, None)
+    return header
+
+def checkHash(data, check):
+    s = hashlib.sha256()
+    s.update(data)
+    calc = s.digest()
+    return (calc == check)
+
+def checkImageHash(image, header):
+    # Flash images hold imgSegmentInfo bytes at imgStart, images that are loaded into RAM have the data right after the header
+    (offset, length) = (header.imgStart, header.imgSegmentInfo)
+    if offset < headerSchema.bootHeader.size or offset + length > len(image):
+        (offset, length) = (headerSchema.bootHeader.size, len(image) - headerSchema.bootHeader.size)
+    calculated = hashlib.sha256(memoryview(image)[offset:offset+length]).digest()
+    return HashStatus(calculated == header.sha256hash, offset, length, calculated)
+
+def inspectImage(image):
+    # Returns the boot header and hash status of an image, raises an exception when the header is not valid
+    header = parseBootHeader(image)
+    return (header, checkImageHash(image, header))
+
+# Byte fields that have always been printed with four digits
+wideFields = ["deBurstWrapData"]
+
+def printRecord(record):
+    for (name, fmt) in record.schema.fields:
+        if name in ["magic", "crc32", "rsvd"]:
+            continue
+        value = getattr(record, name)
+        if fmt == "L":
+            # Register commands are stored as 4 command bytes
+            text = " ".join(["0x{:02x}".format(byte) for byte in struct.pack("<L", value)])
+        elif fmt == "H" or name in wideFields:
+            text = "0x{:04x}".format(value)
+        else:
+            text = "0x{:02x}".format(value)
+        print(name + "\t" * ((32 - len(name) + 7) // 8) + text)
+    print()
 
 def readFlashCfg(data):
-    if len(data) != 92:
-        print("[FL] data length is wrong: {:d}, expected 92".format(len(data)))
-        return None
-    (magic, ioMode, cReadSupport, clkDelay, clkInvert, resetEnCmd, resetCmd, resetCreadCmd, resetCreadCmdSize, jedecIdCmd, jedecIdCmdDmyClk, qpiJedecIdCmd, qpiJedecIdCmdDmyClk, sectorSize, mid, pageSize, chipEraseCmd, sectorEraseCmd, blk32EraseCmd, blk64EraseCmd, writeEnableCmd, pageProgramCmd, qpageProgramCmd, qppAddrMode, fastReadCmd, frDmyClk, qpiFastReadCmd, qpiFrDmyClk, fastReadDoCmd, frDoDmyClk, fastReadDioCmd, frDioDmyClk, fastReadQoCmd, frQoDmyClk, fastReadQioCmd, frQioDmyClk, qpiFastReadQioCmd, qpiFrQioDmyClk, qpiPageProgramCmd, writeVregEnableCmd, wrEnableIndex, qeIndex, busyIndex, wrEnableBit, qeBit, busyBit, wrEnableWriteRegLen, wrEnableReadRegLen, qeWriteRegLen, qeReadRegLen, releasePowerDown, busyReadRegLen, readRegCmd, writeRegCmd, enterQpi, exitQpi, cReadMode, cRExit, burstWrapCmd, burstWrapCmdDmyClk, burstWrapDataMode, burstWrapData, deBurstWrapCmd, deBurstWrapCmdDmyClk, deBurstWrapDataMode, deBurstWrapData, timeEsector, timeE32k, timeE64k, timePagePgm, timeCe, pdDelay, qeData, crc32) = struct.unpack("<4sBBBBBBBBBBBBBBHBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB4s4sBBBBBBBBBBBBHHHHHBBL", data)
-    if magic != b"FCFG":
-        print("[FL] magic is wrong ({}), expected FCFG".format(magic))
-        print()
-        return None
-    calcCrc32 = binascii.crc32(data[4:-4], 0)
-    if crc32 != calcCrc32:
-        print("[FL] crc32 is wrong", crc32, calcCrc32)
+    try:
+        config = parseFlashConfig(data)
+    except Exception as e:
+        print(*e.args)
         print()
         return None
     print("Flash configuration")
     print("----------------------------------------------------------------------------------------------------------")
-    print("ioMode\t\t\t\t0x{:02x}".format(ioMode))
-    print("cReadSupport\t\t\t0x{:02x}".format(cReadSupport))
-    print("clkDelay\t\t\t0x{:02x}".format(clkDelay))
-    print("clkInvert\t\t\t0x{:02x}".format(clkInvert))
-    print("resetEnCmd\t\t\t0x{:02x}".format(resetEnCmd))
-    print("resetCmd\t\t\t0x{:02x}".format(resetCmd))
-    print("resetCreadCmd\t\t\t0x{:02x}".format(resetCreadCmd))
-    print("resetCreadCmdSize\t\t0x{:02x}".format(resetCreadCmdSize))
-    print("jedecIdCmd\t\t\t0x{:02x}".format(jedecIdCmd))
-    print("jedecIdCmdDmyClk\t\t0x{:02x}".format(jedecIdCmdDmyClk))
-    print("qpiJedecIdCmd\t\t\t0x{:02x}".format(qpiJedecIdCmd))
-    print("qpiJedecIdCmdDmyClk\t\t0x{:02x}".format(qpiJedecIdCmdDmyClk))
-    print("sectorSize\t\t\t0x{:02x}".format(sectorSize))
-    print("mid\t\t\t\t0x{:02x}".format(mid))
-    print("pageSize\t\t\t0x{:04x}".format(pageSize))
-    print("chipEraseCmd\t\t\t0x{:02x}".format(chipEraseCmd))
-    print("sectorEraseCmd\t\t\t0x{:02x}".format(sectorEraseCmd))
-    print("blk32EraseCmd\t\t\t0x{:02x}".format(blk32EraseCmd))
-    print("blk64EraseCmd\t\t\t0x{:02x}".format(blk64EraseCmd))
-    print("writeEnableCmd\t\t\t0x{:02x}".format(writeEnableCmd))
-    print("pageProgramCmd\t\t\t0x{:02x}".format(pageProgramCmd))
-    print("qpageProgramCmd\t\t\t0x{:02x}".format(qpageProgramCmd))
-    print("qppAddrMode\t\t\t0x{:02x}".format(qppAddrMode))
-    print("fastReadCmd\t\t\t0x{:02x}".format(fastReadCmd))
-    print("frDmyClk\t\t\t0x{:02x}".format(frDmyClk))
-    print("qpiFastReadCmd\t\t\t0x{:02x}".format(qpiFastReadCmd))
-    print("qpiFrDmyClk\t\t\t0x{:02x}".format(qpiFrDmyClk))
-    print("fastReadDoCmd\t\t\t0x{:02x}".format(fastReadDoCmd))
-    print("frDoDmyClk\t\t\t0x{:02x}".format(frDoDmyClk))
-    print("fastReadDioCmd\t\t\t0x{:02x}".format(fastReadDioCmd))
-    print("frDioDmyClk\t\t\t0x{:02x}".format(frDioDmyClk))
-    print("fastReadQoCmd\t\t\t0x{:02x}".format(fastReadQoCmd))
-    print("frQoDmyClk\t\t\t0x{:02x}".format(frQoDmyClk))
-    print("fastReadQioCmd\t\t\t0x{:02x}".format(fastReadQioCmd))
-    print("frQioDmyClk\t\t\t0x{:02x}".format(frQioDmyClk))
-    print("qpiFastReadQioCmd\t\t0x{:02x}".format(qpiFastReadQioCmd))
-    print("qpiFrQioDmyClk\t\t\t0x{:02x}".format(qpiFrQioDmyClk))
-    print("qpiPageProgramCmd\t\t0x{:02x}".format(qpiPageProgramCmd))
-    print("writeVregEnableCmd\t\t0x{:02x}".format(writeVregEnableCmd))
-    print("wrEnableIndex\t\t\t0x{:02x}".format(wrEnableIndex))
-    print("qeIndex\t\t\t\t0x{:02x}".format(qeIndex))
-    print("busyIndex\t\t\t0x{:02x}".format(busyIndex))
-    print("wrEnableBit\t\t\t0x{:02x}".format(wrEnableBit))
-    print("qeBit\t\t\t\t0x{:02x}".format(qeBit))
-    print("busyBit\t\t\t\t0x{:02x}".format(busyBit))
-    print("wrEnableWriteRegLen\t\t0x{:02x}".format(wrEnableWriteRegLen))
-    print("wrEnableReadRegLen\t\t0x{:02x}".format(wrEnableReadRegLen))
-    print("qeWriteRegLen\t\t\t0x{:02x}".format(qeWriteRegLen))
-    print("qeReadRegLen\t\t\t0x{:02x}".format(qeReadRegLen))
-    print("releasePowerDown\t\t0x{:02x}".format(releasePowerDown))
-    print("busyReadRegLen\t\t\t0x{:02x}".format(busyReadRegLen))
-    print("readRegCmd\t\t\t0x{:02x} 0x{:02x} 0x{:02x} 0x{:02x}".format(readRegCmd[0], readRegCmd[1], readRegCmd[2], readRegCmd[3]))
-    print("writeRegCmd\t\t\t0x{:02x} 0x{:02x} 0x{:02x} 0x{:02x}".format(writeRegCmd[0], writeRegCmd[1], writeRegCmd[2], writeRegCmd[3]))
-    print("enterQpi\t\t\t0x{:02x}".format(enterQpi))
-    print("exitQpi\t\t\t\t0x{:02x}".format(exitQpi))
-    print("cReadMode\t\t\t0x{:02x}".format(cReadMode))
-    print("cRExit\t\t\t\t0x{:02x}".format(cRExit))
-    print("burstWrapCmd\t\t\t0x{:02x}".format(burstWrapCmd))
-    print("burstWrapCmdDmyClk\t\t0x{:02x}".format(burstWrapCmdDmyClk))
-    print("burstWrapDataMode\t\t0x{:02x}".format(burstWrapDataMode))
-    print("burstWrapData\t\t\t0x{:02x}".format(burstWrapData))
-    print("deBurstWrapCmd\t\t\t0x{:02x}".format(deBurstWrapCmd))
-    print("deBurstWrapCmdDmyClk\t\t0x{:02x}".format(deBurstWrapCmdDmyClk))
-    print("deBurstWrapDataMode\t\t0x{:02x}".format(deBurstWrapDataMode))
-    print("deBurstWrapData\t\t\t0x{:04x}".format(deBurstWrapData))
-    print("timeEsector\t\t\t0x{:04x}".format(timeEsector))
-    print("timeE32k\t\t\t0x{:04x}".format(timeE32k))
-    print("timeE64k\t\t\t0x{:04x}".format(timeE64k))
-    print("timePagePgm\t\t\t0x{:04x}".format(timePagePgm))
-    print("timeCe\t\t\t\t0x{:04x}".format(timeCe))
-    print("pdDelay\t\t\t\t0x{:02x}".format(pdDelay))
-    print("qeData\t\t\t\t0x{:02x}".format(qeData))
-    print()
+    printRecord(config)
+    return config
 
 def readClockConfig(data):
-    if len(data) != 16:
-        print("[CL] data length is wrong: {:d}, expected 16".format(len(data)))
-        print()
-        return None
-    (magic, xtalType, pllClk, hclkDiv, bclkDiv, flashClkType, flashClkDiv, rsvd, crc32) = struct.unpack("<4sBBBBBBHL", data)
-    if magic != b"PCFG":
-        print("[CL] magic is wrong ({}), expected PCFG".format(magic))
-        print()
-        return None
-    calcCrc32 = binascii.crc32(data[4:-4], 0)
-    if crc32 != calcCrc32:
-        print("[FL] crc32 is wrong", crc32, calcCrc32)
+    try:
+        config = parseClockConfig(data)
+    except Exception as e:
+        print(*e.args)
         print()
         return None
     print("Clock configuration")
     print("----------------------------------------------------------------------------------------------------------")
-    print("xtalType\t\t\t0x{:02x}".format(xtalType))
-    print("pllClk\t\t\t\t0x{:02x}".format(pllClk))
-    print("hclkDiv\t\t\t\t0x{:02x}".format(hclkDiv))
-    print("bclkDiv\t\t\t\t0x{:02x}".format(bclkDiv))
-    print("flashClkType\t\t\t0x{:02x}".format(flashClkType))
-    print("flashClkDiv\t\t\t0x{:02x}".format(flashClkDiv))
-    print()
-
-def checkHash(data, check):
-    s = hashlib.sha256()
-    s.update(data)
-    calc = s.digest()
-    return (calc == check)
+    printRecord(config)
+    return config
 
 def readBootHeader(image):
-    if len(image) < 176:
-        print("[BL] data too short")
-        return None
-    header = image[:176]
-    data = image[176:]
-    (magic, revision, flashCfg, clkCfg, bootCfg, imgSegmentInfo, bootEntry, imgStart, sha256hash, rsvd1, rsvd2, crc32) = struct.unpack('<4sL92s16sLLLL32sLLL', header)
-    if magic != b"BFNP":
-        print("[BH] magic is wrong ({}), expected BFNP".format(magic))
-        print()
-        return None
-    calcCrc32 = binascii.crc32(header[0:-4], 0)
-    if crc32 != calcCrc32:
-        print("[BH] crc32 is wrong", crc32, calcCrc32)
+    try:
+        (header, status) = inspectImage(image)
+    except Exception as e:
+        print(*e.args)
         print()
         return None
-    print("Boot header revision: 0x{:02x}".format(revision))
-    readFlashCfg(flashCfg)
-    readClockConfig(clkCfg)
+    print("Boot header revision: 0x{:02x}".format(header.revision))
+    readFlashCfg(image[8:100])
+    readClockConfig(image[100:116])
     print("Image information")
     print("----------------------------------------------------------------------------------------------------------")
-    print("bootCfg\t\t\t\t0x{:04x}".format(bootCfg))
-    print("imgSegmentInfo\t\t\t0x{:04x}".format(imgSegmentInfo))
-    print("bootEntry\t\t\t0x{:04x}".format(bootEntry))
-    print("imgStart\t\t\t0x{:04x}".format(imgStart))
-    print("SHA256 hash\t\t\t{}".format(binascii.hexlify(sha256hash).decode("utf-8")))
+    print("bootCfg\t\t\t\t0x{:04x}".format(header.bootCfg))
+    print("imgSegmentInfo\t\t\t0x{:04x}".format(header.imgSegmentInfo))
+    print("bootEntry\t\t\t0x{:04x}".format(header.bootEntry))
+    print("imgStart\t\t\t0x{:04x}".format(header.imgStart))
+    print("SHA256 hash\t\t\t{}".format(binascii.hexlify(header.sha256hash).decode("utf-8")))
     print()
-    if not checkHash(data, sha256hash):
+    if not status.match:
         print("SHA256 hash does NOT match!!!")
     else:
         print("SHA256 hash matches, this is a valid image file")
+    return header
+
+def recordToDict(record):
+    result = {}
+    values = record.asDict() if isinstance(record, headerSchema.Record) else record._asdict()
+    for (name, value) in values.items():
+        if isinstance(value, headerSchema.Record):
+            value = recordToDict(value)
+        elif type(value) == bytes:
+            value = binascii.hexlify(value).decode("ascii")
+        result[name] = value
+    return result
+
+def inspectFile(filename):
+    # Returns a JSON serializable description of a file, the file is mapped instead of read
+    result = {"file": filename, "valid": False, "error": None}
+    try:
+        with open(filename, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            result["size"] = size
+            if size < headerSchema.bootHeader.size:
+                raise Exception("[BL] data too short")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as image:
+                (header, status) = inspectImage(image)
+        result["header"] = recordToDict(header)
+        result["hash"] = recordToDict(status)
+        result["valid"] = status.match
+    except Exception as e:
+        result["error"] = " ".join([str(arg) for arg in e.args])
+    return result
+
+def findFiles(paths, pattern):
+    for path in paths:
+        if os.path.isdir(path):
+            for (directory, subdirectories, filenames) in os.walk(path):
+                subdirectories.sort()
+                for filename in sorted(filenames):
+                    if fnmatch.fnmatch(filename, pattern):
+                        yield os.path.join(directory, filename)
+        else:
+            yield path
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the boot header of a BL602 image")
+    parser.add_argument("files", nargs="+", help="Image file, or files and directories in batch mode")
+    parser.add_argument("-b", "--batch", dest="batch", action="store_true", help="Check all files and write a JSON line per file")
+    parser.add_argument("--pattern", dest="pattern", default="*.bin", help="Files to check in directories in batch mode (default: *.bin)")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=None, help="Amount of processes to use in batch mode (default: amount of CPUs)")
+    parser.add_argument("-o", "--output", dest="output", help="File to write the JSON lines to (default: standard output)")
+    args = parser.parse_args()
 
+    if not args.batch:
+        with open(args.files[0], 'rb') as f:
+            data = f.read()
+        readBootHeader(data)
+        return
 
-with open(sys.argv[1], 'rb') as f:
-    data = f.read()
+    output = sys.stdout
+    if args.output:
+        output = open(args.output, "w")
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+        # Results are written in order as soon as they are available
+        for result in executor.map(inspectFile, findFiles(args.files, args.pattern), chunksize=16):
+            output.write(json.dumps(result) + "\n")
+    if args.output:
+        output.close()
 
-readBootHeader(data)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Copyright 2020 Renze Nicolai
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os, sys, random, hashlib, argparse, tempfile, unittest
+
+# The tools are scripts in the directory above, the loaders are opened relative to it
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import bltool, bldaemon, blsim, headerSchema, generateHeaders
+
+class Interrupted(BaseException):
+    # Stands in for the user pressing ctrl+c or unplugging the board, nothing in bltool catches it
+    pass
+
+def readFile(name):
+    with open(os.path.join(root, name), "rb") as f:
+        return f.read()
+
+def createDevice(**kwargs):
+    # A small and fast device, only the protocol matters here
+    device = blsim.SimulatedDevice(0x40000, processingDelay = 0.0001, **kwargs)
+    for name in device.timing:
+        device.timing[name] /= 100
+    return device
+
+def createSession(device, baudrates = [2000000, 1000000]):
+    # Starts talking to an eflash loader that is already running, without uploading it
+    device.mode = "eflash"
+    eflash = bltool.EflashLoaderCommunication(blsim.SimulatedPort(device, baudrates[0]), False, bltool.Reporter("sim"))
+    eflash.negotiateBaudrate(baudrates)
+    return eflash
+
+class TestHelpers(unittest.TestCase):
+    def testPlanErase(self):
+        self.assertEqual(bltool.planErase(0x1800, 0x1000), [(0x1000, 0x1000), (0x2000, 0x1000)])
+        self.assertEqual(bltool.planErase(0, 0x20000), [(0, 0x10000), (0x10000, 0x10000)])
+        self.assertEqual(bltool.planErase(0x8000, 0x9000), [(0x8000, 0x8000), (0x10000, 0x1000)])
+        self.assertEqual(bltool.planErase(0x10000, 0), [])
+
+    def testPlanRegions(self):
+        a = (0x0, bytes(0x100), "a")
+        b = (0x200, bytes(0x100), "b")
+        c = (0x1000, bytes(0x100), "c")
+        d = (0x3000, bytes(0x100), "d")
+        empty = (0x5000, bytes([]), "empty")
+        self.assertEqual(bltool.planRegions([d, c, empty, b, a]), [[a, b], [c], [d]])
+        with self.assertRaises(Exception):
+            bltool.planRegions([a, (0x80, bytes(0x100), "overlap")])
+
+    def testDataExtents(self):
+        data = bytes([0xFF] * 0x100) + bytes(0x200) + bytes([0xFF] * 0x300) + bytes(0x10)
+        self.assertEqual(bltool.dataExtents(data), [(0x100, 0x200), (0x600, 0x10)])
+        self.assertEqual(bltool.dataExtents(bytes([0xFF] * 0x1000)), [])
+
+    def testHeaderSchemaRoundTrip(self):
+        image = readFile("testfiles/compare.bin")
+        data = image[:headerSchema.bootHeader.size]
+        header = headerSchema.bootHeader.decode(data)
+        self.assertEqual(header.encode(), data)
+        self.assertEqual(headerSchema.bootHeader.decodeMany(data * 2), [header, header])
+        self.assertEqual(headerSchema.bootHeader.encodeMany([header, header]), data * 2)
+        self.assertEqual(type(headerSchema.bootHeader.encodeMany([header])), bytes)
+        with self.assertRaises(Exception):
+            headerSchema.bootHeader.decode(data[:-1] + bytes([data[-1] ^ 0x01]))
+
+    def testClockConfigValidate(self):
+        clock = generateHeaders.ClockConfig()
+        flash = generateHeaders.FlashConfig().appFlashConfig
+        for (name, profile) in clock.clockProfiles.items():
+            clock.validate(profile, flash)
+        self.assertEqual(clock.validate(clock.defaultClockConfig), {"xclk": 40.0, "hclk": 160.0, "bclk": 80.0, "flash": 40.0})
+        # The PLL does not run without a crystal
+        with self.assertRaises(Exception):
+            clock.validate(dict(clock.defaultClockConfig, xtalType=clock.xtalTypes["none"]))
+        # The bus can not run at the CPU clock
+        with self.assertRaises(Exception):
+            clock.validate(dict(clock.defaultClockConfig, bclkDiv=0))
+
+class TestSimulator(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+        self.directory = tempfile.TemporaryDirectory()
+        self.options = argparse.Namespace(baudrate=[2000000], flashBaudrate=["auto"], loader=["auto"], pipeline=[4], logging=False, info=False, reload=False)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def writeFile(self, name, data):
+        name = os.path.join(self.directory.name, name)
+        with open(name, "wb") as f:
+            f.write(data)
+        return name
+
+    def runJob(self, eflash, request):
+        return bltool.runActions(eflash, "sim", bldaemon.jobArguments(request, self.options))
+
+    def fillRandom(self, device, start, end):
+        device.flash[start:end] = bytes([random.randrange(256) for i in range(end - start)])
+        return bytes(device.flash)
+
+    def testStartSession(self):
+        # Boards with a 40 MHz crystal in their boot header get the 40m loader, others the rc32m loader
+        cwd = os.getcwd()
+        os.chdir(root)
+        try:
+            for (image, loader) in [(None, "rc32m"), ("testfiles/compare.bin", "40m")]:
+                device = createDevice()
+                if image != None:
+                    data = readFile(image)
+                    device.flash[:len(data)] = data
+                eflash = bltool.startSession(blsim.SimulatedPort(device, 2000000), self.options, bltool.Reporter("sim"))
+                self.assertEqual(bytes(device.segmentData), readFile(bltool.loaderFiles[loader])[192:])
+                self.assertEqual(eflash.readJedecId(), device.jedecId)
+        finally:
+            os.chdir(cwd)
+
+    def testWriteAndVerify(self):
+        device = createDevice()
+        before = self.fillRandom(device, 0x10000, 0x14000)
+        eflash = createSession(device)
+        data = bytes([random.randrange(256) for i in range(0x1800)])
+        name = self.writeFile("a.bin", data)
+        self.assertTrue(self.runJob(eflash, {"write": [{"address": 0x10100, "file": name}], "verify": True}))
+        # The data around the write is kept
+        self.assertEqual(bytes(device.flash), before[:0x10100] + data + before[0x11900:])
+
+    def testVerifyFailure(self):
+        device = createDevice()
+        eflash = createSession(device)
+        name = self.writeFile("a.bin", bytes(0x1000))
+        self.runJob(eflash, {"write": [{"address": 0x10000, "file": name}]})
+        device.flash[0x10800] = 0x01
+        self.assertFalse(self.runJob(eflash, {"write": [{"address": 0x10000, "file": name}], "verifyOnly": True}))
+
+    def testVerifyOnlyDoesNotErase(self):
+        device = createDevice()
+        before = self.fillRandom(device, 0x10000, 0x11000)
+        eflash = createSession(device)
+        name = self.writeFile("a.bin", before[0x10000:0x11000])
+        self.assertTrue(self.runJob(eflash, {"write": [{"address": 0x10000, "file": name}], "verifyOnly": True, "erase": True}))
+        self.assertEqual(bytes(device.flash), before)
+        self.assertEqual(device.commandCounts.get(0x3C, 0) + device.commandCounts.get(0x30, 0), 0)
+
+    def testDifferential(self):
+        device = createDevice()
+        eflash = createSession(device)
+        data = bytearray([random.randrange(256) for i in range(0x8000)])
+        self.runJob(eflash, {"write": [{"address": 0x10000, "file": self.writeFile("a.bin", data)}]})
+        data[0x3000:0x3010] = bytes(0x10)
+        device.commandCounts = {}
+        self.assertTrue(self.runJob(eflash, {"write": [{"address": 0x10000, "file": self.writeFile("b.bin", data)}], "differential": True, "verify": True}))
+        self.assertEqual(bytes(device.flash[0x10000:0x18000]), bytes(data))
+        # Only the sector that changed is erased and written
+        self.assertEqual(device.commandCounts[0x30], 1)
+        self.assertEqual(device.commandCounts[0x31], 2)
+
+    def testJournalResumesInterruptedErase(self):
+        device = createDevice()
+        before = self.fillRandom(device, 0x1F000, 0x24000)
+        eflash = createSession(device)
+        data = bytes(range(256)) * 32
+        request = {"write": [{"address": 0x20100, "file": self.writeFile("a.bin", data)}], "journal": os.path.join(self.directory.name, "journal"), "verify": True}
+        original = eflash.executeCommand
+        erases = []
+        def executeCommand(cmd, *args, **kwargs):
+            if cmd == "flash_erase":
+                erases.append(cmd)
+                if len(erases) == 2:
+                    raise Interrupted()
+            return original(cmd, *args, **kwargs)
+        eflash.executeCommand = executeCommand
+        with self.assertRaises(Interrupted):
+            self.runJob(eflash, request)
+        eflash.executeCommand = original
+        self.assertTrue(self.runJob(eflash, request))
+        self.assertEqual(bytes(device.flash), before[:0x20100] + data + before[0x20100+len(data):])
+        self.assertEqual(os.listdir(request["journal"]), [])
+
+    def testJournalKeepsGaps(self):
+        device = createDevice()
+        before = self.fillRandom(device, 0x20000, 0x21000)
+        eflash = createSession(device)
+        request = {"write": [{"address": 0x20000, "file": self.writeFile("a.bin", bytes([0x11]) * 0x100)}, {"address": 0x20200, "file": self.writeFile("b.bin", bytes([0x22]) * 0x100)}], "journal": os.path.join(self.directory.name, "journal")}
+        original = eflash.writeFlash
+        def writeFlash(*args, **kwargs):
+            raise Interrupted()
+        eflash.writeFlash = writeFlash
+        with self.assertRaises(Interrupted):
+            self.runJob(eflash, request)
+        eflash.writeFlash = original
+        self.assertTrue(self.runJob(eflash, dict(request, verify=True)))
+        self.assertEqual(bytes(device.flash), before[:0x20000] + bytes([0x11]) * 0x100 + before[0x20100:0x20200] + bytes([0x22]) * 0x100 + before[0x20300:])
+
+    def failOnce(self, device, commands, response):
+        # Makes the device answer the first of each of the commands with the response, None sends no response at all
+        failed = []
+        execute = device.execute
+        def failFirst(cmdId, checksum, params):
+            if cmdId in commands and not cmdId in failed:
+                failed.append(cmdId)
+                return (response, 0)
+            return execute(cmdId, checksum, params)
+        device.execute = failFirst
+        return failed
+
+    def testDroppedResponses(self):
+        # A missing response is repeated at the same baudrate instead of dropping back
+        device = createDevice()
+        eflash = createSession(device)
+        data = bytes([random.randrange(256) for i in range(0x2000)])
+        self.runJob(eflash, {"write": [{"address": 0x10000, "file": self.writeFile("a.bin", data)}]})
+        eflash.readFlash(0x10000, 0x100)
+        failed = self.failOnce(device, [0x30, 0x32, 0x3D], None)
+        eflash.eraseRegion(0x30000, 0x1000)
+        self.assertEqual(eflash.readHash(0x10000, len(data)), hashlib.sha256(data).digest())
+        self.assertEqual(bytes(eflash.readFlash(0x10000, len(data))), data)
+        self.assertEqual(sorted(failed), [0x30, 0x32, 0x3D])
+        self.assertEqual(eflash.port.baudrate, 2000000)
+        self.assertEqual(eflash.fallbackBaudrates, [1000000])
+
+    def testDeviceErrors(self):
+        # Erase and program errors are retried, also when there is no slower baudrate to drop back to
+        device = createDevice()
+        eflash = createSession(device, [2000000])
+        failed = self.failOnce(device, [0x30, 0x31], device.error(0x0301))
+        data = bytes([random.randrange(256) for i in range(0x3000)])
+        self.assertTrue(self.runJob(eflash, {"write": [{"address": 0x10000, "file": self.writeFile("a.bin", data)}], "verify": True}))
+        self.assertEqual(sorted(failed), [0x30, 0x31])
+        self.assertEqual(bytes(device.flash[0x10000:0x13000]), data)
+
+    def testErrorsAreNotLinkErrors(self):
+        # An address the device rejects raises right away instead of dropping back to slower baudrates
+        device = createDevice()
+        eflash = createSession(device)
+        with self.assertRaises(Exception):
+            eflash.eraseRegion(0x40000, 0x1000)
+        self.assertEqual(eflash.port.baudrate, 2000000)
+        self.assertEqual(eflash.fallbackBaudrates, [1000000])
+
+if __name__ == "__main__":
+    unittest.main()